@@ -1,18 +1,50 @@
 import os
 import shutil
 import logging
+import logging.handlers
 import time
 import random
+import struct
+import pickle
 import multiprocessing
 import multiprocessing.queues as mpq
-from queue import Empty
+from multiprocessing import shared_memory
+from queue import Empty, Full
 
 PROJECT_ROOT = os.path.realpath(os.path.join(os.path.dirname(__file__), '..'))
 LOG_DIR = os.path.join(PROJECT_ROOT, 'logs')
 WEB_DRIVER_DIR = os.path.join(PROJECT_ROOT, 'chrome')
+CACHE_DIR = os.path.join(PROJECT_ROOT, 'cache')
+
+
+# Set by use_log_queue in processes that log through the LogPipeline writer.
+log_queue = None
+log_process_tag = None
+
+
+def use_log_queue(queue, process_tag):
+    global log_queue, log_process_tag
+    log_queue = queue
+    log_process_tag = process_tag
+
+
+def tag_process(record):
+    record.process_tag = log_process_tag
+    return True
 
 
 def create_logger(logger_name, log_level=logging.INFO, log_file_path=None, log_file_mode='w'):
+    if log_queue is not None:
+        # The writer process owns the console and the log files.
+        logger = logging.getLogger(logger_name)
+        if not any(isinstance(handler, logging.handlers.QueueHandler)
+                   for handler in logger.handlers):
+            queue_handler = logging.handlers.QueueHandler(log_queue)
+            queue_handler.addFilter(tag_process)
+            logger.addHandler(queue_handler)
+        logger.setLevel(log_level)
+        return logger
+
     formatter = logging.Formatter(
         "%(asctime)s [%(levelname)-5.5s]  %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
     console_handler = logging.StreamHandler()
@@ -57,3 +89,138 @@ class CommunicationQueue(mpq.Queue):
                 self.get_nowait()
         except Empty:
             pass
+
+    def release(self):
+        self.close()
+
+
+class SharedMemoryRingQueue(object):
+    """Single-producer/single-consumer ring of length-prefixed records in
+    shared memory. Only the producer moves `head` and only the consumer
+    moves `tail`, so no lock is needed. Both offsets grow monotonically and
+    are wrapped onto the data area on access.
+    """
+    HEAD_OFFSET = 0
+    TAIL_OFFSET = 64  # keep head and tail on separate cache lines
+    DATA_OFFSET = 128
+    LEN_PREFIX = struct.Struct("<I")
+    OFFSET = struct.Struct("<Q")
+
+    def __init__(self, capacity=4 * 1024 * 1024, poll_interval=0.001):
+        self.capacity = capacity
+        self.poll_interval = poll_interval
+        self.shm = shared_memory.SharedMemory(
+            create=True, size=self.DATA_OFFSET + capacity)
+        self.owner = True
+        self.OFFSET.pack_into(self.shm.buf, self.HEAD_OFFSET, 0)
+        self.OFFSET.pack_into(self.shm.buf, self.TAIL_OFFSET, 0)
+
+    def __getstate__(self):
+        return (self.shm.name, self.capacity, self.poll_interval)
+
+    def __setstate__(self, state):
+        name, self.capacity, self.poll_interval = state
+        self.shm = shared_memory.SharedMemory(name=name)
+        self.owner = False
+
+    def _load(self, offset):
+        return self.OFFSET.unpack_from(self.shm.buf, offset)[0]
+
+    def _store(self, offset, value):
+        self.OFFSET.pack_into(self.shm.buf, offset, value)
+
+    def _write(self, pos, data):
+        start = self.DATA_OFFSET + pos % self.capacity
+        first = min(len(data), self.DATA_OFFSET + self.capacity - start)
+        self.shm.buf[start:start + first] = data[:first]
+        if first < len(data):
+            rest = len(data) - first
+            self.shm.buf[self.DATA_OFFSET:self.DATA_OFFSET + rest] = data[first:]
+
+    def _read(self, pos, size):
+        start = self.DATA_OFFSET + pos % self.capacity
+        first = min(size, self.DATA_OFFSET + self.capacity - start)
+        data = bytes(self.shm.buf[start:start + first])
+        if first < size:
+            data += bytes(self.shm.buf[self.DATA_OFFSET:self.DATA_OFFSET + size - first])
+        return data
+
+    def _wait(self, deadline, delay):
+        if deadline is not None and time.monotonic() >= deadline:
+            return None
+        time.sleep(delay)
+        return min(delay * 2, self.poll_interval * 10)
+
+    def put_bytes(self, data, block=True, timeout=None):
+        size = self.LEN_PREFIX.size + len(data)
+        if size > self.capacity:
+            raise ValueError("record of {} bytes exceeds ring capacity {}".format(
+                len(data), self.capacity))
+        deadline = None if timeout is None else time.monotonic() + timeout
+        delay = self.poll_interval
+        while True:
+            head = self._load(self.HEAD_OFFSET)
+            tail = self._load(self.TAIL_OFFSET)
+            if self.capacity - (head - tail) >= size:
+                break
+            if not block:
+                raise Full
+            delay = self._wait(deadline, delay)
+            if delay is None:
+                raise Full
+        self._write(head, self.LEN_PREFIX.pack(len(data)) + data)
+        # Publish only after the record is fully written.
+        self._store(self.HEAD_OFFSET, head + size)
+
+    def get_bytes(self, block=True, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        delay = self.poll_interval
+        while True:
+            tail = self._load(self.TAIL_OFFSET)
+            if self._load(self.HEAD_OFFSET) != tail:
+                break
+            if not block:
+                raise Empty
+            delay = self._wait(deadline, delay)
+            if delay is None:
+                raise Empty
+        size = self.LEN_PREFIX.unpack(self._read(tail, self.LEN_PREFIX.size))[0]
+        data = self._read(tail + self.LEN_PREFIX.size, size)
+        self._store(self.TAIL_OFFSET, tail + self.LEN_PREFIX.size + size)
+        return data
+
+    def put(self, obj, block=True, timeout=None):
+        self.put_bytes(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL), block, timeout)
+
+    def put_nowait(self, obj):
+        self.put(obj, False)
+
+    def get(self, block=True, timeout=None):
+        return pickle.loads(self.get_bytes(block, timeout))
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def get_no_throw(self, *args):
+        try:
+            return self.get(*args)
+        except Empty:
+            return None
+
+    def empty(self):
+        return self._load(self.HEAD_OFFSET) == self._load(self.TAIL_OFFSET)
+
+    def clear(self):
+        # Discard everything written so far in O(1), consumer side only.
+        self._store(self.TAIL_OFFSET, self._load(self.HEAD_OFFSET))
+
+    def release(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def create_comm_queue(transport="queue", maxsize=500, capacity=4 * 1024 * 1024):
+    if transport == "shm":
+        return SharedMemoryRingQueue(capacity=capacity)
+    return CommunicationQueue(maxsize=maxsize)
@@ -0,0 +1,82 @@
+import os
+import time
+import sqlite3
+import threading
+
+from chatgpdou.similarity import normalize_question
+
+
+class AnswerCache(object):
+    """Normalized question -> answer, persisted in SQLite.
+
+    Entries expire after ttl_sec, and the least recently used ones are
+    evicted once there are more than max_entries. Safe to share between
+    the web bot threads.
+    """
+
+    def __init__(self, path, max_entries=5000, ttl_sec=3 * 24 * 3600):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_sec = ttl_sec
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            "key TEXT PRIMARY KEY, question TEXT, answer TEXT, "
+            "created REAL, last_used REAL, hits INTEGER DEFAULT 0)")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS answers_last_used ON answers (last_used)")
+        self.conn.commit()
+        self.evict()
+
+    def get(self, question):
+        key = normalize_question(question)
+        if not key:
+            return None
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT answer, created FROM answers WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            answer, created = row
+            if now - created > self.ttl_sec:
+                self.conn.execute("DELETE FROM answers WHERE key = ?", (key,))
+                self.conn.commit()
+                return None
+            self.conn.execute(
+                "UPDATE answers SET last_used = ?, hits = hits + 1 WHERE key = ?",
+                (now, key))
+            self.conn.commit()
+        return answer
+
+    def put(self, question, answer):
+        key = normalize_question(question)
+        if not key or not answer:
+            return
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO answers (key, question, answer, created, last_used) "
+                "VALUES (?, ?, ?, ?, ?)", (key, question, answer, now, now))
+            self.conn.commit()
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM answers WHERE created < ?",
+                              (time.time() - self.ttl_sec,))
+            self.conn.execute(
+                "DELETE FROM answers WHERE key IN (SELECT key FROM answers "
+                "ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+            self.conn.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,188 @@
+import json
+import time
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from chatgpdou import create_logger
+from chatgpdou.metrics import metrics
+
+
+class AnswerBackend(object):
+    """What BotScheduler needs from something that answers questions.
+
+    send_question() starts an answer and wait_answer() blocks until it is
+    complete, filling last_answer and last_answer_timing. The screen
+    methods do nothing for backends without a page of their own.
+    """
+    name = "backend"
+
+    def __init__(self):
+        self.last_question = None
+        self.last_answer = None
+        self.last_answer_timing = None
+
+    def bring_to_foreground(self):
+        pass
+
+    def set_count_down(self, time_interval=15):
+        pass
+
+    def show_answer(self, q_text, answer):
+        pass
+
+    def read_answer(self):
+        return self.last_answer
+
+    def send_question(self, q_text):
+        raise NotImplementedError
+
+    def wait_answer(self, timeout_sec=60):
+        raise NotImplementedError
+
+    def quit(self):
+        pass
+
+
+def create_http_session(concurrency):
+    # One keep-alive pool shared by all HTTP backends.
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class HTTPStreamingBackend(AnswerBackend):
+    """Answers through an OpenAI-style chat completions endpoint with
+    stream=true, reading the server-sent events as they arrive.
+
+    Several backends can share one session, each one is a concurrent
+    answer slot. With a display (a ChatGPTWebBot), the countdown and the
+    finished answer are shown on its page; backends sharing a display must
+    share its display_lock too.
+    """
+
+    def __init__(self, api_url, model, session, api_key=None, name="http",
+                 system_prompt=None, display=None, display_lock=None,
+                 transcript=None, logger=None):
+        super().__init__()
+        if not logger:
+            self.logger = create_logger("http_backend")
+        else:
+            self.logger = logger
+        self.url = api_url.rstrip("/") + "/chat/completions"
+        self.model = model
+        self.session = session
+        self.headers = {"Content-Type": "application/json"}
+        if api_key:
+            self.headers["Authorization"] = "Bearer {}".format(api_key)
+        self.name = name
+        self.system_prompt = system_prompt
+        self.display = display
+        self.display_lock = display_lock or threading.Lock()
+        self.transcript = transcript
+        self.response = None
+        self.sent = None
+        self.timeouts_metric = metrics.counter(
+            "wait_answer_timeouts_total", "wait_answer calls that gave up")
+
+    def bring_to_foreground(self):
+        if self.display is not None:
+            with self.display_lock:
+                self.display.bring_to_foreground()
+
+    def set_count_down(self, time_interval=15):
+        if self.display is not None:
+            with self.display_lock:
+                self.display.set_count_down(time_interval)
+
+    def show_answer(self, q_text, answer):
+        if self.display is not None:
+            with self.display_lock:
+                self.display.show_answer(q_text, answer)
+
+    def send_question(self, q_text, timeout_sec=10):
+        messages = [{"role": "user", "content": q_text}]
+        if self.system_prompt:
+            messages.insert(0, {"role": "system", "content": self.system_prompt})
+        self.sent = time.time()
+        response = self.session.post(
+            self.url, headers=self.headers, stream=True, timeout=timeout_sec,
+            json={"model": self.model, "messages": messages, "stream": True})
+        try:
+            response.raise_for_status()
+        except requests.RequestException:
+            # Hand the pooled connection back right away.
+            response.close()
+            raise
+        self.response = response
+        self.last_question = q_text
+        self.logger.info("Sent question: {}".format(q_text))
+
+    def wait_answer(self, timeout_sec=60):
+        self.last_answer = None
+        self.last_answer_timing = None
+        if self.transcript is not None:
+            self.transcript.begin_answer(self.name, self.last_question)
+        text = ""
+        chunks = 0
+        first_chunk = None
+        completed = False
+        deadline = self.sent + timeout_sec
+        try:
+            # Bytes, not decode_unicode: servers often leave out the charset
+            # and requests would then split lines on ISO-8859-1 \x85.
+            for line in self.response.iter_lines():
+                if time.time() > deadline:
+                    break
+                line = line.decode("utf-8", errors="replace")
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    completed = True
+                    break
+                choice = json.loads(data)["choices"][0]
+                delta = choice.get("delta", {}).get("content")
+                if delta:
+                    if first_chunk is None:
+                        first_chunk = time.time()
+                    text += delta
+                    chunks += 1
+                    if self.transcript is not None:
+                        self.transcript.write_chunk(self.name, {"delta": delta, "replace": False})
+                if choice.get("finish_reason"):
+                    completed = True
+                    break
+        except requests.RequestException as e:
+            self.logger.warning("Answer stream broken: {}".format(str(e)))
+        except (ValueError, KeyError, IndexError) as e:
+            # A malformed event leaves the answer incomplete.
+            self.logger.warning("Malformed answer event: {}".format(str(e)))
+        finally:
+            self.response.close()
+            self.response = None
+
+        self.last_answer = text
+        end = time.time()
+        if completed:
+            self.last_answer_timing = {
+                "time_to_first_chunk_sec": first_chunk - self.sent
+                if first_chunk is not None else None,
+                "stream_sec": end - (first_chunk or end),
+                "total_sec": end - self.sent,
+                "chars": len(text),
+                "chunks": chunks,
+            }
+        if self.transcript is not None:
+            self.transcript.end_answer(
+                self.name, self.last_question, text, self.last_answer_timing)
+        if not completed:
+            self.timeouts_metric.inc(labels={"reason": "answer_timeout"})
+            return False
+        self.show_answer(self.last_question, text)
+        self.logger.info("Answering complete, first chunk after {:.2f}s, {} chars".format(
+            self.last_answer_timing["time_to_first_chunk_sec"] or 0, len(text)))
+        return True
@@ -0,0 +1,118 @@
+import time
+import heapq
+
+from chatgpdou.similarity import normalize_question
+
+
+class BacklogEntry(object):
+    def __init__(self, key, question, now):
+        self.key = key
+        self.question = question
+        self.user_ids = set()
+        self.first_seen = now
+        self.last_seen = now
+        self.activity = 0.0
+        self.version = 0
+
+
+class QuestionBacklog(object):
+    """Questions that were not picked yet, kept across rounds.
+
+    Priority grows with the number of distinct askers and the gift/like
+    activity of those askers, and drops by age_rate per second since the
+    question was last asked. As every entry ages at the same rate, the
+    heap key score + age_rate * last_seen keeps the order without
+    re-scoring. Entries older than max_age_sec are dropped, and the
+    backlog never holds more than max_size questions.
+    """
+
+    def __init__(self, max_size=2000, max_age_sec=600, ask_weight=1.0,
+                 like_weight=0.01, gift_weight=1.0, age_rate=1.0 / 60):
+        self.max_size = max_size
+        self.max_age_sec = max_age_sec
+        self.ask_weight = ask_weight
+        self.like_weight = like_weight
+        self.gift_weight = gift_weight
+        self.age_rate = age_rate
+        self.entries = {}
+        self.user_keys = {}
+        self.heap = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def score(self, entry):
+        return (self.ask_weight * len(entry.user_ids) + entry.activity
+                + self.age_rate * entry.last_seen)
+
+    def push(self, entry):
+        entry.version += 1
+        heapq.heappush(self.heap, (-self.score(entry), entry.version, entry.key))
+        if len(self.heap) > 4 * max(len(self.entries), 64):
+            self.compact()
+
+    def compact(self):
+        self.heap = [(-self.score(entry), entry.version, entry.key)
+                     for entry in self.entries.values()]
+        heapq.heapify(self.heap)
+
+    def add(self, user_id, question, now=None):
+        key = normalize_question(question)
+        if not key:
+            return
+        now = time.time() if now is None else now
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = BacklogEntry(key, question, now)
+            self.entries[key] = entry
+        entry.user_ids.add(user_id)
+        entry.last_seen = now
+        self.user_keys[user_id] = key
+        self.push(entry)
+        if len(self.entries) > self.max_size:
+            self.trim(now)
+
+    def add_activity(self, user_id, method, amount):
+        # Gifts and likes of a viewer lift the question they asked last.
+        key = self.user_keys.get(user_id)
+        entry = self.entries.get(key)
+        if entry is None:
+            return
+        if method == 'WebcastGiftMessage':
+            entry.activity += self.gift_weight * amount
+        else:
+            entry.activity += self.like_weight * amount
+        self.push(entry)
+
+    def discard(self, question):
+        entry = self.entries.pop(normalize_question(question), None)
+        if entry is not None:
+            for user_id in entry.user_ids:
+                if self.user_keys.get(user_id) == entry.key:
+                    del self.user_keys[user_id]
+
+    def pop(self, now=None):
+        now = time.time() if now is None else now
+        while self.heap:
+            _, version, key = heapq.heappop(self.heap)
+            entry = self.entries.get(key)
+            if entry is None or entry.version != version:
+                continue
+            if now - entry.last_seen > self.max_age_sec:
+                self.discard(entry.question)
+                continue
+            self.discard(entry.question)
+            return entry
+        return None
+
+    def trim(self, now):
+        expired = [entry.question for entry in self.entries.values()
+                   if now - entry.last_seen > self.max_age_sec]
+        for question in expired:
+            self.discard(question)
+        if len(self.entries) > self.max_size:
+            # Keep the best 90%, so trimming doesn't run on every insert.
+            ranked = sorted(self.entries.values(), key=self.score, reverse=True)
+            for entry in ranked[int(self.max_size * 0.9):]:
+                self.discard(entry.question)
+        self.compact()
@@ -0,0 +1,245 @@
+import gc
+import sys
+import json
+import gzip
+import time
+import random
+import logging
+import argparse
+import tracemalloc
+
+from douyin_live.dy_pb2 import PushFrame
+from douyin_live.dy_pb2 import Response
+from douyin_live.dy_pb2 import Message
+from douyin_live.dy_pb2 import ChatMessage
+from douyin_live.dy_pb2 import LikeMessage
+from douyin_live.dy_pb2 import GiftMessage
+from douyin_live.dy_pb2 import MemberMessage
+
+from chatgpdou import create_logger
+from chatgpdou.capture import FrameReader
+from chatgpdou.douyin import QuestionSelector
+from chatgpdou.douyin import parse_push_frame
+from chatgpdou.douyin import decompress_payload
+from chatgpdou.douyin import parse_response
+from chatgpdou.douyin import decode_record
+from chatgpdou.questions import default_questions
+
+stages = ["push_frame_parse", "gzip_decompress", "response_parse",
+          "chat_decode", "add_question", "checkout_question"]
+
+quiet_logger = create_logger("bench", log_level=logging.WARNING)
+
+message_builders = {}
+
+
+def message_builder(kind):
+    def register(fn):
+        message_builders[kind] = fn
+        return fn
+    return register
+
+
+@message_builder("chat")
+def build_chat(rng, user_id, now):
+    message = ChatMessage()
+    message.user.shortId = user_id
+    message.user.nickName = "user_{}".format(user_id)
+    if rng.random() < 0.5:
+        message.content = "提问 " + rng.choice(default_questions)
+    else:
+        message.content = "主播好" * rng.randint(1, 5)
+    message.eventTime = now
+    return "WebcastChatMessage", message
+
+
+@message_builder("like")
+def build_like(rng, user_id, now):
+    message = LikeMessage()
+    message.user.shortId = user_id
+    message.count = rng.randint(1, 15)
+    message.total = rng.randint(1, 100000)
+    return "WebcastLikeMessage", message
+
+
+@message_builder("gift")
+def build_gift(rng, user_id, now):
+    message = GiftMessage()
+    message.user.shortId = user_id
+    message.giftId = rng.randint(1, 500)
+    message.repeatCount = rng.randint(1, 10)
+    return "WebcastGiftMessage", message
+
+
+@message_builder("member")
+def build_member(rng, user_id, now):
+    message = MemberMessage()
+    message.user.shortId = user_id
+    message.user.nickName = "user_{}".format(user_id)
+    return "WebcastMemberMessage", message
+
+
+def parse_mix(mix):
+    weights = {}
+    for item in mix.split(","):
+        kind, weight = item.split("=")
+        if kind not in message_builders:
+            raise ValueError("Unknown message kind: {}".format(kind))
+        weights[kind] = float(weight)
+    return weights
+
+
+def synthetic_frames(frame_num, messages_per_frame, room_size, mix, seed=0):
+    rng = random.Random(seed)
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    now = int(time.time())
+    frames = []
+    for log_id in range(frame_num):
+        response = Response()
+        for kind in rng.choices(kinds, weights, k=messages_per_frame):
+            method, message = message_builders[kind](
+                rng, rng.randint(1, room_size), now)
+            msg = Message()
+            msg.method = method
+            msg.payload = message.SerializeToString()
+            response.messagesList.append(msg)
+        response.needAck = True
+        frame = PushFrame()
+        frame.logId = log_id
+        frame.payloadType = "msg"
+        frame.payload = gzip.compress(response.SerializeToString())
+        frames.append(frame.SerializeToString())
+    return frames
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0
+    idx = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+def run_pipeline(frames, window_frames, samples=None):
+    # Runs the production hot path on each frame, stage by stage as
+    # decode_push_frame composes them in the wss worker, then the main
+    # process's add_question and checkout_question. Stage durations (ns)
+    # are appended to samples when given.
+    clock = time.perf_counter_ns
+    selector = QuestionSelector(None, logger=quiet_logger)
+    for idx, frame_bytes in enumerate(frames):
+        t0 = clock()
+        push_frame = parse_push_frame(frame_bytes)
+        t1 = clock()
+        decompressed = decompress_payload(push_frame)
+        t2 = clock()
+        response = parse_response(decompressed)
+        t3 = clock()
+        if samples is not None:
+            samples["push_frame_parse"].append(t1 - t0)
+            samples["gzip_decompress"].append(t2 - t1)
+            samples["response_parse"].append(t3 - t2)
+        for msg in response.messagesList:
+            if msg.method != "WebcastChatMessage":
+                decode_record(msg)
+                continue
+            t0 = clock()
+            record = decode_record(msg)
+            t1 = clock()
+            selector.add_question(record.user_id, record.content,
+                                  record.event_time, record.nickname)
+            t2 = clock()
+            if samples is not None:
+                samples["chat_decode"].append(t1 - t0)
+                samples["add_question"].append(t2 - t1)
+        if (idx + 1) % window_frames == 0:
+            t0 = clock()
+            if selector.questions:
+                selector.checkout_question()
+            selector.reset_window()
+            t1 = clock()
+            if samples is not None:
+                samples["checkout_question"].append(t1 - t0)
+
+
+def benchmark(frames, window_frames):
+    samples = {stage: [] for stage in stages}
+    gc.collect()
+    start = time.perf_counter()
+    run_pipeline(frames, window_frames)
+    elapsed = time.perf_counter() - start
+
+    run_pipeline(frames, window_frames, samples)
+
+    gc.collect()
+    tracemalloc.start()
+    run_pipeline(frames, window_frames)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = {
+        "frames": len(frames),
+        "frames_per_sec": len(frames) / elapsed if elapsed > 0 else 0,
+        "peak_memory_kb": peak / 1024,
+        "stages": {},
+    }
+    for stage in stages:
+        values = sorted(samples[stage])
+        result["stages"][stage] = {
+            "count": len(values),
+            "p50_us": percentile(values, 50) / 1000,
+            "p99_us": percentile(values, 99) / 1000,
+        }
+    return result
+
+
+def print_result(result):
+    print("frames: {}, frames/sec: {:.1f}, peak memory: {:.1f} KiB".format(
+        result["frames"], result["frames_per_sec"], result["peak_memory_kb"]))
+    print("{:<20}{:>10}{:>12}{:>12}".format("stage", "count", "p50 (us)", "p99 (us)"))
+    for stage, stats in result["stages"].items():
+        print("{:<20}{:>10}{:>12.2f}{:>12.2f}".format(
+            stage, stats["count"], stats["p50_us"], stats["p99_us"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Micro-benchmark of the wss decode and question selection hot path')
+    parser.add_argument("--frames", type=int, default=2000)
+    parser.add_argument("--messages_per_frame", type=int, default=10)
+    parser.add_argument("--room_size", type=int, default=5000,
+                        help="number of distinct viewers")
+    parser.add_argument("--mix", type=str,
+                        default="chat=0.4,like=0.3,gift=0.1,member=0.2",
+                        help="message kind weights, kinds: {}".format(
+                            ",".join(message_builders)))
+    parser.add_argument("--window_frames", type=int, default=200,
+                        help="frames per collection window before checkout_question")
+    parser.add_argument("--capture", type=str, default=None,
+                        help="benchmark frames from a capture file instead of synthetic ones")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None,
+                        help="append the result as one JSON line, to track runs over time")
+    args = parser.parse_args()
+
+    if args.capture:
+        frames = [frame for _, frame in FrameReader(args.capture).frames()]
+        params = {"capture": args.capture}
+    else:
+        frames = synthetic_frames(args.frames, args.messages_per_frame,
+                                  args.room_size, parse_mix(args.mix), args.seed)
+        params = {"messages_per_frame": args.messages_per_frame,
+                  "room_size": args.room_size, "mix": args.mix}
+
+    result = benchmark(frames, args.window_frames)
+    result["params"] = params
+    result["timestamp"] = time.time()
+    print_result(result)
+    if args.output:
+        with open(args.output, "a", encoding="utf-8") as output:
+            output.write(json.dumps(result, ensure_ascii=False) + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,147 @@
+import os
+import time
+import random
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from chatgpdou import create_logger
+from chatgpdou import WEB_DRIVER_DIR
+from chatgpdou.chatgpt import ChatGPTWebBot
+from chatgpdou.metrics import metrics
+
+
+def launch_web_bots(user_data_dirs, logger=None, transcript=None):
+    # The first launch patches the chromedriver binary, the others start
+    # together once it is in place.
+    def launch(user_data_dir):
+        web_bot = ChatGPTWebBot(chrome_user_data_dir=user_data_dir,
+                                logger=logger, transcript=transcript)
+        web_bot.go_chat_page()
+        return web_bot
+
+    if not user_data_dirs:
+        return []
+    web_bots = [launch(user_data_dirs[0])]
+    if len(user_data_dirs) > 1:
+        with ThreadPoolExecutor(max_workers=len(user_data_dirs) - 1) as executor:
+            web_bots += list(executor.map(launch, user_data_dirs[1:]))
+    return web_bots
+
+
+def prepare_web_bots(web_bots, ready_timeout_sec=120):
+    # Waits for all chat pages at once, then sets them up.
+    def prepare(web_bot):
+        if not web_bot.wait_page_ready(ready_timeout_sec):
+            raise RuntimeError("{} chat page not ready".format(web_bot.name))
+        web_bot.prepare_chat_page()
+
+    if not web_bots:
+        return
+    with ThreadPoolExecutor(max_workers=len(web_bots)) as executor:
+        list(executor.map(prepare, web_bots))
+
+
+class BrowserPool(object):
+    """Warm standby web bots for replacing broken ones.
+
+    Standby bots use their own profiles, user_data_<first_idx> and up, and
+    are launched and prepared in the background before anyone needs them.
+    swap() hands out a warm bot right away; the broken one is quit, left to
+    cool down for cooldown_sec and relaunched as a new standby, all off the
+    answering path. With no standby warm within swap_timeout_sec, swap()
+    raises RuntimeError and the broken bot stays in place.
+    """
+
+    def __init__(self, first_idx, standby_num=1, logger=None, transcript=None,
+                 cooldown_sec=(120, 130), ready_timeout_sec=120, swap_timeout_sec=30):
+        if not logger:
+            self.logger = create_logger("browser_pool")
+        else:
+            self.logger = logger
+        self.transcript = transcript
+        self.cooldown_sec = cooldown_sec
+        self.ready_timeout_sec = ready_timeout_sec
+        self.swap_timeout_sec = swap_timeout_sec
+        self.standby = queue.Queue()
+        # Profiles to launch, either fresh ones or those of recycled bots
+        self.launch_queue = queue.Queue()
+        for idx in range(first_idx, first_idx + standby_num):
+            self.launch_queue.put((os.path.join(
+                WEB_DRIVER_DIR, "user_data_{}".format(idx)), 0))
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name="browser_pool")
+
+        self.swaps_metric = metrics.counter("browser_swaps_total",
+                                            "Broken web bots replaced by a standby")
+        self.swap_wait_metric = metrics.histogram(
+            "browser_swap_wait_seconds", "Time waiting for a warm standby")
+        self.standby_metric = metrics.gauge("standby_browsers", "Warm standby web bots")
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                user_data_dir, not_before = self.launch_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            if not_before > time.time():
+                self.launch_queue.put((user_data_dir, not_before))
+                self.stopped.wait(min(1, not_before - time.time()))
+                continue
+            try:
+                web_bot = self.launch(user_data_dir)
+            except Exception as e:
+                self.logger.warning("Launching standby {} failed: {}".format(
+                    user_data_dir, str(e)))
+                self.launch_queue.put((user_data_dir, self.cooled_down_at()))
+                continue
+            self.standby.put(web_bot)
+            self.standby_metric.set(self.standby.qsize())
+            self.logger.info("Standby {} is warm".format(web_bot.name))
+
+    def launch(self, user_data_dir):
+        web_bot = ChatGPTWebBot(chrome_user_data_dir=user_data_dir,
+                                logger=self.logger, transcript=self.transcript)
+        if not web_bot.wait_page_ready(self.ready_timeout_sec):
+            web_bot.quit()
+            raise RuntimeError("chat page not ready")
+        web_bot.prepare_chat_page()
+        return web_bot
+
+    def swap(self, broken_bot):
+        start = time.time()
+        try:
+            web_bot = self.standby.get(timeout=self.swap_timeout_sec)
+        except queue.Empty:
+            raise RuntimeError("no warm standby for {} within {}s".format(
+                broken_bot.name, self.swap_timeout_sec))
+        finally:
+            self.swap_wait_metric.observe(time.time() - start)
+        self.swaps_metric.inc()
+        self.standby_metric.set(self.standby.qsize())
+        self.logger.info("Swapped broken {} for standby {}".format(
+            broken_bot.name, web_bot.name))
+        self.recycle(broken_bot)
+        return web_bot
+
+    def recycle(self, broken_bot):
+        threading.Thread(target=broken_bot.quit, daemon=True,
+                         name="recycle_{}".format(broken_bot.name)).start()
+        self.launch_queue.put((broken_bot.user_data_dir, self.cooled_down_at()))
+
+    def cooled_down_at(self):
+        return time.time() + random.uniform(*self.cooldown_sec)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        while True:
+            try:
+                self.standby.get_nowait().quit()
+            except queue.Empty:
+                break
@@ -0,0 +1,110 @@
+import os
+import time
+import struct
+import bisect
+
+# Capture file layout, append-only:
+#   MAGIC, then per frame: <receive timestamp f64><length u32><raw PushFrame bytes>
+# The sidecar index (<path>.idx) holds one <offset u64><timestamp f64> entry
+# per frame, so a reader can seek by time without scanning the capture.
+MAGIC = b"CGDCAP1\n"
+FRAME_HEADER = struct.Struct("<dI")
+INDEX_ENTRY = struct.Struct("<Qd")
+
+
+def index_path_of(path):
+    return path + ".idx"
+
+
+class FrameRecorder(object):
+    """Appends frames to a capture and its index, flushing every
+    flush_every frames or flush_interval_sec, whichever comes first.
+    """
+
+    def __init__(self, path, flush_every=100, flush_interval_sec=1):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_interval_sec = flush_interval_sec
+        self.capture_file = open(path, "ab")
+        if self.capture_file.tell() == 0:
+            self.capture_file.write(MAGIC)
+        self.index_file = open(index_path_of(path), "ab")
+        self.offset = self.capture_file.tell()
+        self.pending = 0
+        self.flushed_at = time.time()
+
+    def write(self, frame_bytes, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        self.capture_file.write(FRAME_HEADER.pack(timestamp, len(frame_bytes)))
+        self.capture_file.write(frame_bytes)
+        self.index_file.write(INDEX_ENTRY.pack(self.offset, timestamp))
+        self.offset += FRAME_HEADER.size + len(frame_bytes)
+        self.pending += 1
+        if self.pending >= self.flush_every \
+                or timestamp - self.flushed_at >= self.flush_interval_sec:
+            self.flush()
+
+    def flush(self):
+        self.capture_file.flush()
+        self.index_file.flush()
+        self.pending = 0
+        self.flushed_at = time.time()
+
+    def close(self):
+        self.flush()
+        self.capture_file.close()
+        self.index_file.close()
+
+
+class FrameReader(object):
+    def __init__(self, path):
+        self.path = path
+        self.offsets = []
+        self.timestamps = []
+        if os.path.exists(index_path_of(path)):
+            with open(index_path_of(path), "rb") as index_file:
+                data = index_file.read()
+            # A torn trailing entry from a crashed recorder is ignored.
+            usable = len(data) - len(data) % INDEX_ENTRY.size
+            for offset, timestamp in INDEX_ENTRY.iter_unpack(data[:usable]):
+                self.offsets.append(offset)
+                self.timestamps.append(timestamp)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def frames(self, start_time=None):
+        # Yields (timestamp, frame_bytes), optionally from start_time on.
+        with open(self.path, "rb") as capture_file:
+            if capture_file.read(len(MAGIC)) != MAGIC:
+                raise ValueError("{} is not a frame capture".format(self.path))
+            if start_time is not None and self.offsets:
+                pos = bisect.bisect_left(self.timestamps, start_time)
+                if pos >= len(self.offsets):
+                    return
+                capture_file.seek(self.offsets[pos])
+            while True:
+                header = capture_file.read(FRAME_HEADER.size)
+                if len(header) < FRAME_HEADER.size:
+                    return
+                timestamp, size = FRAME_HEADER.unpack(header)
+                frame_bytes = capture_file.read(size)
+                if len(frame_bytes) < size:
+                    return
+                yield timestamp, frame_bytes
+
+
+def replay_schedule(frames, speed=1.0):
+    # Yields (delay_sec, frame_bytes) keeping the recorded spacing divided by
+    # speed. speed <= 0 replays as fast as possible.
+    first_ts = None
+    start = time.time()
+    for timestamp, frame_bytes in frames:
+        if first_ts is None:
+            first_ts = timestamp
+        delay = 0
+        if speed > 0:
+            delay = start + (timestamp - first_ts) / speed - time.time()
+        yield max(delay, 0), frame_bytes
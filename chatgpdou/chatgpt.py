@@ -5,22 +5,27 @@ import logging
 #from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
-from selenium.common.exceptions import NoSuchElementException
+from selenium.webdriver.support import expected_conditions
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.common.exceptions import TimeoutException
 from undetected_chromedriver import Chrome, ChromeOptions
 
 from chatgpdou import create_logger
 from chatgpdou import LOG_DIR, WEB_DRIVER_DIR
 from chatgpdou import random_delay
+from chatgpdou.metrics import metrics
+from chatgpdou.backends import AnswerBackend
 
 env = dict(os.environ)
 env['PATH'] = os.path.abspath(WEB_DRIVER_DIR) + os.pathsep + env['PATH']
 os.environ.update(env)
 
 
-class ChatGPTWebBot(object):
+class ChatGPTWebBot(AnswerBackend):
     def __init__(self,
                  chrome_user_data_dir=None,
-                 logger=None) -> None:
+                 logger=None,
+                 transcript=None) -> None:
         self.chatgpt_url = "https://chat.openai.com/chat"
         self.add_hint_board_js = """
 const mainElem = document.getElementsByTagName('main')[0];
@@ -57,17 +62,177 @@ hintBoard.appendChild(countdown);
 mainElem.appendChild(hintBoard);
         """
 
+        # Restarting replaces the running countdown, 0 ends it right away.
         self.count_down_js = """
 const countdown = document.getElementById("chatgpdou_hint_board_countdown");
+if (window.chatgpdouCountdown) {{
+    clearInterval(window.chatgpdouCountdown);
+}}
 var count = {0};
-var set = setInterval(function() {{
-    count--;
-    countdown.innerHTML = "请在" + String(count) + "秒内输入提问";
-    if (count <= 0) {{
-      clearInterval(set);
-      countdown.innerHTML = "倒计时在本轮提问结束后自动开始";
-    }}
-}}, 1000);
+if (count <= 0) {{
+    countdown.innerHTML = "倒计时在本轮提问结束后自动开始";
+}} else {{
+    window.chatgpdouCountdown = setInterval(function() {{
+        count--;
+        countdown.innerHTML = "请在" + String(count) + "秒内输入提问";
+        if (count <= 0) {{
+          clearInterval(window.chatgpdouCountdown);
+          countdown.innerHTML = "倒计时在本轮提问结束后自动开始";
+        }}
+    }}, 1000);
+}}
+"""
+
+        # Records when an answer starts and stops streaming, and the text
+        # it streams as timestamped deltas, so Python can wait on it with
+        # async script calls instead of polling the DOM.
+        self.stream_observer_js = """
+if (window.chatgpdouStream) {
+    return;
+}
+var state = {waiters: []};
+state.reset = function() {
+    state.sent = Date.now();
+    state.start = null;
+    state.firstChunk = null;
+    state.end = null;
+    state.elem = null;
+    state.text = "";
+    state.chunks = [];
+    state.drained = 0;
+};
+state.reset();
+state.notify = function() {
+    state.waiters = state.waiters.filter(function(waiter) {
+        var value = waiter.check();
+        if (value === null) {
+            return true;
+        }
+        waiter.resolve(value);
+        return false;
+    });
+};
+state.capture = function() {
+    var text = state.elem.textContent;
+    if (text === state.text) {
+        return;
+    }
+    var chunk = {t: Date.now(), replace: !text.startsWith(state.text)};
+    chunk.delta = chunk.replace ? text : text.slice(state.text.length);
+    state.text = text;
+    state.chunks.push(chunk);
+    if (state.firstChunk === null) {
+        state.firstChunk = chunk.t;
+    }
+};
+var observer = new MutationObserver(function() {
+    var elem = document.querySelector("div.result-streaming");
+    if (elem !== null && state.start === null) {
+        state.start = Date.now();
+        state.elem = elem;
+    }
+    if (state.elem !== null && state.end === null) {
+        state.capture();
+        if (elem === null) {
+            state.end = Date.now();
+        }
+    }
+    state.notify();
+});
+observer.observe(document.body, {
+    subtree: true, childList: true, characterData: true,
+    attributes: true, attributeFilter: ["class"]
+});
+window.chatgpdouStream = state;
+"""
+
+        self.wait_stream_js = """
+var key = arguments[0];
+var timeoutMs = arguments[1];
+var done = arguments[arguments.length - 1];
+var state = window.chatgpdouStream;
+if (!state) {
+    done(-1);
+    return;
+}
+window.chatgpdouWait(state, function() { return state[key]; }, timeoutMs, done, null);
+"""
+
+        # Returns the deltas after `cursor` once the answer has ended, or
+        # there are new ones and intervalMs passed since the last drain, or
+        # timeoutMs passed. The page keeps collecting deltas in between, so
+        # a streaming answer costs a WebDriver call about once per interval.
+        self.drain_answer_js = """
+var cursor = arguments[0][0];
+var intervalMs = arguments[0][1];
+var timeoutMs = arguments[1];
+var done = arguments[arguments.length - 1];
+var state = window.chatgpdouStream;
+if (!state) {
+    done(-1);
+    return;
+}
+var check = function() {
+    if (state.end === null && (state.chunks.length <= cursor
+                               || Date.now() - state.drained < intervalMs)) {
+        return null;
+    }
+    state.drained = Date.now();
+    return {chunks: state.chunks.slice(cursor), sent: state.sent, start: state.start,
+            firstChunk: state.firstChunk, end: state.end};
+};
+window.chatgpdouWait(state, check, timeoutMs, done,
+                     {chunks: [], sent: state.sent, start: state.start,
+                      firstChunk: state.firstChunk, end: null});
+// Deltas that came in before the interval was up and then nothing else.
+setTimeout(state.notify, Math.max(0, state.drained + intervalMs - Date.now()));
+"""
+
+        self.stream_waiter_js = """
+window.chatgpdouWait = function(state, check, timeoutMs, done, timeoutValue) {
+    var value = check();
+    if (value !== null) {
+        done(value);
+        return;
+    }
+    var waiter = {check: check};
+    var timer = setTimeout(function() {
+        state.waiters = state.waiters.filter(function(w) { return w !== waiter; });
+        done(timeoutValue);
+    }, timeoutMs);
+    waiter.resolve = function(value) {
+        clearTimeout(timer);
+        done(value);
+    };
+    state.waiters.push(waiter);
+};
+"""
+
+        self.read_answer_js = """
+var answers = document.querySelectorAll("main div.markdown");
+if (!answers.length) {
+    return null;
+}
+return answers[answers.length - 1].innerText;
+"""
+
+        # Shows a cached answer on the hint board, hidden again on next send.
+        self.show_answer_js = """
+var board = document.getElementById("chatgpdou_hint_board_countdown").parentNode;
+var panel = document.getElementById("chatgpdou_hint_board_answer");
+if (!panel) {
+    panel = document.createElement("div");
+    panel.id = "chatgpdou_hint_board_answer";
+    panel.style.color = "white";
+    panel.style.fontSize = "16px";
+    panel.style.margin = "10px";
+    panel.style.whiteSpace = "pre-wrap";
+    panel.style.maxHeight = "60vh";
+    panel.style.overflowY = "auto";
+    board.appendChild(panel);
+}
+panel.textContent = "问题: " + arguments[0] + "\n\n" + arguments[1];
+panel.style.display = "block";
 """
 
         if not logger:
@@ -76,6 +241,17 @@ var set = setInterval(function() {{
             self.logger = logger
 
         self.default_wait = 40
+        # At most one answer drain per interval while an answer streams
+        self.drain_interval_ms = 1000
+        self.script_timeout_sec = None
+        self.name = os.path.basename(chrome_user_data_dir or "chatgpt_web_bot")
+        self.user_data_dir = chrome_user_data_dir
+        self.transcript = transcript
+        self.last_question = None
+        self.last_answer = None
+        self.last_answer_timing = None
+        self.timeouts_metric = metrics.counter(
+            "wait_answer_timeouts_total", "wait_answer calls that gave up")
         self.driver = None
         self.driver_options = ChromeOptions()
         self.logger.info(
@@ -89,11 +265,33 @@ var set = setInterval(function() {{
 
     def reinitialize_driver(self):
         if self.driver is not None:
+            metrics.counter("driver_reinitializations_total",
+                            "Chrome restarts of broken web bots").inc(labels={"bot": self.name})
             self.driver.quit()
             delattr(self, "driver")
             random_delay(120, 130)
         random_delay(4, 5)
         self.driver = Chrome(options=self.driver_options)
+        self.script_timeout_sec = None
+
+    def quit(self):
+        try:
+            self.driver.quit()
+        except Exception as e:
+            self.logger.warning("Quit {} error: {}".format(self.name, str(e)))
+
+    def wait_page_ready(self, timeout_sec=60):
+        # Ready once the elements prepare_chat_page looks up are there.
+        try:
+            WebDriverWait(self.driver, timeout_sec).until(
+                expected_conditions.presence_of_element_located(
+                    (By.XPATH, "//main//form//textarea")))
+            WebDriverWait(self.driver, timeout_sec).until(
+                expected_conditions.presence_of_element_located(
+                    (By.XPATH, "//main//form//button[contains(@class, 'absolute')]")))
+            return True
+        except TimeoutException:
+            return False
 
     def bring_to_foreground(self):
         self.driver.minimize_window()
@@ -107,6 +305,7 @@ var set = setInterval(function() {{
     def prepare_chat_page(self):
         # Add hint board html onto this page.
         self.driver.execute_script(self.add_hint_board_js)
+        self.install_stream_observer()
         # zoom
         # self.driver.execute_script("document.body.style.zoom = '0.8'")
         # Find input textarea and click button
@@ -118,48 +317,115 @@ var set = setInterval(function() {{
     def set_count_down(self, time_interval=15):
         self.driver.execute_script(self.count_down_js.format(time_interval))
 
+    def read_answer(self):
+        return self.driver.execute_script(self.read_answer_js)
+
+    def show_answer(self, q_text, answer):
+        self.driver.execute_script(self.show_answer_js, q_text, answer)
+        self.logger.info("Showing answer for: {}".format(q_text))
+
+    def install_stream_observer(self):
+        self.driver.execute_script(self.stream_waiter_js)
+        self.driver.execute_script(self.stream_observer_js)
+
+    def run_stream_script(self, script, arg, timeout_sec):
+        # Blocks inside the page until the observer has something for us.
+        # The driver keeps its script timeout, only raise it when needed.
+        if self.script_timeout_sec is None or self.script_timeout_sec < timeout_sec + 5:
+            self.script_timeout_sec = timeout_sec + 5
+            self.driver.set_script_timeout(self.script_timeout_sec)
+        result = self.driver.execute_async_script(
+            script, arg, int(timeout_sec * 1000))
+        if result == -1:
+            # Page was reloaded, observer is gone.
+            self.install_stream_observer()
+            result = self.driver.execute_async_script(
+                script, arg, int(timeout_sec * 1000))
+        return result
+
+    def wait_stream(self, key, timeout_sec):
+        return self.run_stream_script(self.wait_stream_js, key, timeout_sec)
+
     def wait_answer(self, timeout_sec=60):
-        self.driver.implicitly_wait(10)
-        try:
-            self.driver.find_element(
-                By.XPATH, "//div[contains(@class, 'result-streaming')]")
-        except NoSuchElementException:
-            self.driver.implicitly_wait(self.default_wait)
+        self.last_answer = None
+        self.last_answer_timing = None
+        stream_start = self.wait_stream("start", 10)
+        if stream_start is None:
+            self.timeouts_metric.inc(labels={"reason": "no_stream"})
             return False
         self.logger.info("ChatGPT start streaming answer...")
+        if self.transcript is not None:
+            self.transcript.begin_answer(self.name, self.last_question)
 
-        self.driver.implicitly_wait(0)
-        start = time.time()
+        text = ""
+        cursor = 0
+        state = None
+        deadline = time.time() + timeout_sec
         while True:
-            time.sleep(3)
-            if time.time() - start > timeout_sec:
-                try:
-                    stop_button = self.driver.find_element(By.XPATH,
-                                                           "//main//form//button[contains(@class, 'btn')]")
-                    stop_button.click()
-                except Exception as e:
-                    self.logger.warning(
-                        "Click stop button error, plz check, msg: {}".format(str(e)))
-                    pass
-                self.driver.implicitly_wait(self.default_wait)
-                return False
-            try:
-                self.driver.find_element(
-                    By.XPATH, "//div[contains(@class, 'result-streaming')]")
-            except NoSuchElementException:
+            time_left = deadline - time.time()
+            if time_left <= 0:
                 break
-        self.driver.implicitly_wait(self.default_wait)
-        self.logger.info("Answering complete")
+            state = self.run_stream_script(
+                self.drain_answer_js, [cursor, self.drain_interval_ms], min(time_left, 5))
+            for chunk in state["chunks"]:
+                if chunk["replace"]:
+                    text = chunk["delta"]
+                else:
+                    text += chunk["delta"]
+                if self.transcript is not None:
+                    self.transcript.write_chunk(self.name, chunk)
+            cursor += len(state["chunks"])
+            if state["end"] is not None:
+                break
+
+        self.last_answer = text
+        completed = state is not None and state["end"] is not None
+        if completed:
+            self.last_answer_timing = {
+                "time_to_first_chunk_sec": (state["firstChunk"] - state["sent"]) / 1000
+                if state["firstChunk"] is not None else None,
+                "stream_sec": (state["end"] - state["start"]) / 1000,
+                "total_sec": (state["end"] - state["sent"]) / 1000,
+                "chars": len(text),
+                "chunks": cursor,
+            }
+        if self.transcript is not None:
+            self.transcript.end_answer(
+                self.name, self.last_question, text, self.last_answer_timing)
+
+        if not completed:
+            self.timeouts_metric.inc(labels={"reason": "answer_timeout"})
+            self.driver.implicitly_wait(0)
+            try:
+                stop_button = self.driver.find_element(By.XPATH,
+                                                       "//main//form//button[contains(@class, 'btn')]")
+                stop_button.click()
+            except Exception as e:
+                self.logger.warning(
+                    "Click stop button error, plz check, msg: {}".format(str(e)))
+                pass
+            self.driver.implicitly_wait(self.default_wait)
+            return False
+        self.logger.info("Answering complete, first chunk after {}s, streamed {:.1f}s, {} chars".format(
+            self.last_answer_timing["time_to_first_chunk_sec"],
+            self.last_answer_timing["stream_sec"], len(text)))
         return True
 
     def send_question(self, q_text):
         # clear
         self.text_area.send_keys(Keys.CONTROL + "a")
         self.text_area.send_keys(Keys.DELETE)
-        # input text
-        self.text_area.send_keys(q_text)
+        # input text, Enter would send it, so line breaks are Shift+Enter;
+        # NULL releases Shift before the next line.
+        self.text_area.send_keys(
+            (Keys.SHIFT + Keys.ENTER + Keys.NULL).join(q_text.split("\n")))
         time.sleep(2)
+        self.driver.execute_script(
+            "if (window.chatgpdouStream) { window.chatgpdouStream.reset(); }"
+            "var panel = document.getElementById('chatgpdou_hint_board_answer');"
+            "if (panel) { panel.style.display = 'none'; }")
         self.send_button.click()
+        self.last_question = q_text
         self.logger.info("Sent question: {}".format(q_text))
 
         # div result-streaming markdown prose w-full break-words dark:prose-invert light
@@ -1,20 +1,32 @@
+import os
 import time
 import _thread
+import asyncio
 from collections import OrderedDict
+from collections import namedtuple
+from collections import deque
+from collections import Counter
+from queue import Full
 import random
 import gzip
-import re
-import json
 import logging
-import urllib
 
-import requests
 import websocket
+try:
+    from websockets.asyncio.client import connect as ws_connect
+    WS_HEADER_KWARG = "additional_headers"
+except ImportError:
+    try:
+        from websockets import connect as ws_connect
+        WS_HEADER_KWARG = "extra_headers"
+    except ImportError:
+        ws_connect = None
 
 from douyin_live.dy_pb2 import PushFrame
 from douyin_live.dy_pb2 import Response
 from douyin_live.dy_pb2 import MemberMessage
 from douyin_live.dy_pb2 import GiftMessage
+from douyin_live.dy_pb2 import LikeMessage
 from douyin_live.dy_pb2 import ChatMessage
 from douyin_live.dy_pb2 import SocialMessage
 from douyin_live.dy_pb2 import RoomUserSeqMessage
@@ -23,10 +35,242 @@ from douyin_live.dy_pb2 import CommonTextMessage
 
 from chatgpdou import create_logger
 from chatgpdou.questions import default_questions
+from chatgpdou.capture import FrameRecorder
+from chatgpdou.capture import FrameReader
+from chatgpdou.capture import replay_schedule
+from chatgpdou.similarity import QuestionClusterIndex
+from chatgpdou.metrics import metrics, COUNT_BUCKETS
+from chatgpdou.supervisor import Backoff
+from chatgpdou.room_resolver import RoomResolver
+
+
+# Compact record sent from the wss worker to the main process, one per
+# forwarded message. Frames are decoded once in the worker, so only these
+# small tuples cross the process boundary. `room` is the live url ID the
+# frame was received from. For gift and like records `content` is the
+# gift repeat count / like count; only chat records carry the nickname.
+LiveRecord = namedtuple(
+    "LiveRecord", ["method", "user_id", "content", "event_time", "room", "nickname"],
+    defaults=(None, None))
+
+
+def decode_chat_record(msg, room=None):
+    message = ChatMessage()
+    message.ParseFromString(msg.payload)
+    return LiveRecord(msg.method, message.user.shortId,
+                      message.content, message.eventTime, room, message.user.nickName)
+
+
+def decode_gift_record(msg, room=None):
+    message = GiftMessage()
+    message.ParseFromString(msg.payload)
+    return LiveRecord(msg.method, message.user.shortId,
+                      max(message.repeatCount, 1), int(time.time()), room)
+
+
+def decode_like_record(msg, room=None):
+    message = LikeMessage()
+    message.ParseFromString(msg.payload)
+    return LiveRecord(msg.method, message.user.shortId,
+                      message.count, int(time.time()), room)
+
+
+record_decoders = {
+    'WebcastChatMessage': decode_chat_record,
+    'WebcastGiftMessage': decode_gift_record,
+    'WebcastLikeMessage': decode_like_record,
+}
+
+
+def decode_record(msg, room=None):
+    # None for message types nobody reads
+    decoder = record_decoders.get(msg.method)
+    if decoder is None:
+        return None
+    return decoder(msg, room)
+
+
+def parse_push_frame(frame_bytes):
+    wssPackage = PushFrame()
+    wssPackage.ParseFromString(frame_bytes)
+    return wssPackage
+
+
+def decompress_payload(wssPackage):
+    return gzip.decompress(wssPackage.payload)
+
+
+def parse_response(decompressed):
+    payloadPackage = Response()
+    payloadPackage.ParseFromString(decompressed)
+    return payloadPackage
+
+
+def decode_records(payloadPackage, room=None):
+    records = []
+    for msg in payloadPackage.messagesList:
+        record = decode_record(msg, room)
+        if record is not None:
+            records.append(record)
+    return records
+
+
+def decode_push_frame(frame_bytes, room=None):
+    # The stages are separate functions so python -m chatgpdou.bench can
+    # time each of them.
+    wssPackage = parse_push_frame(frame_bytes)
+    payloadPackage = parse_response(decompress_payload(wssPackage))
+    return wssPackage, payloadPackage, decode_records(payloadPackage, room)
+
+
+class RecordHandoff(object):
+    """Non-blocking hand-off of record batches from the wss loop to the
+    comm_queue. Batches the consumer can't take yet wait in a bounded local
+    buffer; when that is full the overflow policy decides what is dropped:
+
+        drop_oldest   -- drop the oldest pending batch
+        drop_non_chat -- drop the oldest pending batch without chat records,
+                         then fall back to drop_oldest
+        sample        -- replace a random pending batch, keeping a uniform
+                         sample of the traffic
+
+    Dropped records are counted per message method.
+    """
+    overflow_policies = ("drop_oldest", "drop_non_chat", "sample")
+
+    def __init__(self, comm_queue, max_pending=1000, overflow_policy="drop_oldest",
+                 logger=None, report_interval=10):
+        if overflow_policy not in self.overflow_policies:
+            raise ValueError("Unknown overflow policy: {}".format(overflow_policy))
+        if not logger:
+            self.logger = create_logger("record_handoff")
+        else:
+            self.logger = logger
+        self.comm_queue = comm_queue
+        self.max_pending = max_pending
+        self.overflow_policy = overflow_policy
+        self.pending = deque()
+        self.dropped = Counter()
+        self.reported = Counter()
+        self.report_interval = report_interval
+        self.last_report = time.time()
+        self.last_depth_report = 0
+        self.dropped_metric = metrics.counter(
+            "wss_dropped_records_total", "Records dropped by the overflow policy")
+        self.pending_metric = metrics.gauge(
+            "wss_handoff_pending_batches", "Batches waiting for room in the comm queue")
+        self.depth_metric = metrics.gauge(
+            "comm_queue_depth", "Batches in the comm queue")
+
+    def put(self, records):
+        self.pending.append(records)
+        if len(self.pending) > self.max_pending:
+            self.drop_one()
+        self.flush()
+
+    def flush(self):
+        while self.pending:
+            try:
+                self.comm_queue.put_nowait(self.pending[0])
+            except Full:
+                break
+            self.pending.popleft()
+        now = time.time()
+        if now - self.last_depth_report > 1:
+            self.report_depth()
+            self.last_depth_report = now
+        if self.dropped != self.reported and \
+                now - self.last_report > self.report_interval:
+            self.logger.warning("comm queue overflow, dropped records so far: {}".format(
+                dict(self.dropped)))
+            self.reported = Counter(self.dropped)
+            self.last_report = time.time()
+
+    def report_depth(self):
+        self.pending_metric.set(len(self.pending))
+        try:
+            self.depth_metric.set(self.comm_queue.qsize())
+        except (AttributeError, NotImplementedError):
+            pass
+
+    def drop_one(self):
+        if self.overflow_policy == "sample":
+            # The newest batch takes the place of a random pending one.
+            victim_idx = random.randrange(len(self.pending) - 1)
+            victim = self.pending[victim_idx]
+            self.pending[victim_idx] = self.pending.pop()
+        else:
+            victim_idx = 0
+            if self.overflow_policy == "drop_non_chat":
+                for idx, records in enumerate(self.pending):
+                    if not any(record.method == 'WebcastChatMessage' for record in records):
+                        victim_idx = idx
+                        break
+            victim = self.pending[victim_idx]
+            del self.pending[victim_idx]
+        for record in victim:
+            self.dropped[record.method] += 1
+            self.dropped_metric.inc(labels={"method": record.method})
+
+
+class AdaptiveWindow(object):
+    """Collection window length driven by how fast questions come in.
+
+    rate is an EWMA of valid questions per second over past windows. The
+    next window is planned to gather target_questions at that rate, within
+    [min_sec, max_sec], so quiet rooms get longer windows. A window also
+    ends as soon as target_questions arrived, after at least min_sec.
+    """
+
+    def __init__(self, initial_sec=20, min_sec=8, max_sec=40, target_questions=10,
+                 alpha=0.3):
+        self.initial_sec = initial_sec
+        self.min_sec = min_sec
+        self.max_sec = max_sec
+        self.target_questions = target_questions
+        self.alpha = alpha
+        self.rate = None
+        self.rate_metric = metrics.gauge(
+            "question_rate_per_second", "EWMA of valid questions per second")
+        self.window_metric = metrics.histogram(
+            "collection_window_seconds", "Actual length of collection windows")
+
+    def next_interval(self):
+        if self.rate is None:
+            return min(max(self.initial_sec, self.min_sec), self.max_sec)
+        if self.rate <= 0:
+            return self.max_sec
+        return int(round(min(max(self.target_questions / self.rate, self.min_sec),
+                             self.max_sec)))
+
+    def time_to_end(self, elapsed, questions):
+        # Seconds until the window may end early, None while short of
+        # target_questions.
+        if questions < self.target_questions:
+            return None
+        return self.min_sec - elapsed
+
+    def update(self, questions, elapsed):
+        rate = questions / max(elapsed, 1e-3)
+        if self.rate is None:
+            self.rate = rate
+        else:
+            self.rate = self.alpha * rate + (1 - self.alpha) * self.rate
+        self.rate_metric.set(self.rate)
+        self.window_metric.observe(elapsed)
 
 
 class QuestionSelector(object):
-    def __init__(self, comm_queue, logger=None):
+    """Collects the 提问 comments of one window and picks what to ask.
+
+    With batch_size > 1 a round asks up to batch_size questions in one
+    numbered prompt of at most max_prompt_chars, each tagged with the
+    viewer who asked it.
+    """
+    selections = ("cluster", "random")
+
+    def __init__(self, comm_queue, logger=None, selection="cluster", backlog=None,
+                 batch_size=1, max_prompt_chars=500, window=None):
         if not logger:
             self.logger = create_logger("question_selector")
         else:
@@ -35,98 +279,380 @@ class QuestionSelector(object):
         self.comm_queue = comm_queue
         #self.q_format = ''
         self.q_format = '提问'
-        self.message_pool = []
+        # Bounds memory per window, oldest askers are evicted first.
+        self.max_questions = 1000
         self.questions = OrderedDict()
+        # "cluster" asks the most asked question, "random" any of them.
+        self.selection = selection
+        self.clusters = QuestionClusterIndex()
+        # Questions not picked in their own round, None disables it.
+        self.backlog = backlog
+        self.batch_size = batch_size
+        self.max_prompt_chars = max_prompt_chars
+        self.batch_header = "请按编号逐条简短回答下面观众的问题，每条回答以“编号. @观众”开头：\n"
+        # user_id -> nickname, kept across windows for backlog questions
+        self.max_askers = 5000
+        self.askers = OrderedDict()
+
+        if window is None:
+            window = AdaptiveWindow()
+        self.window = window
+        self.ended_early = False
+        # Whether the last selection is a numbered prompt of several questions
+        self.batched = False
+        # Questions of the clusters picked last, in all their wordings
+        self.picked = []
 
-        self.collect_interval_levels = [20]
-        self.collect_level = 0
+        self.window_chat_count = 0
+        self.window_chat_metric = metrics.histogram(
+            "chat_messages_per_window", "Chat messages received in a collection window",
+            buckets=COUNT_BUCKETS)
+        self.selected_metric = metrics.counter(
+            "questions_selected_total", "Questions sent to be answered")
 
     @property
     def collect_interval(self):
-        return self.collect_interval_levels[self.collect_level]
+        return self.window.next_interval()
 
     def collect_and_select_question(self):
         self.start = time.time()
         self.logger.info("=================")
         self.logger.info(
             "Start collecting questions, timestamp {} ...".format(self.start))
-        self.message_pool.clear()
-        self.questions.clear()
+        self.reset_window()
         self.stop = self.start + self.collect_interval + 4 # 4 for broadcast delay
+        self.ended_early = False
+        self.batched = False
         while True:
             now = time.time()
             time_left = self.stop - now
-            if time_left > 0:
-                wss_pkg_payload = self.comm_queue.get_no_throw(True, time_left)
-                if wss_pkg_payload is not None:
-                    self.message_pool.append(wss_pkg_payload)
-            else:
+            if time_left <= 0:
                 break
+            # With enough questions in, wake up by min_sec even if the
+            # room goes quiet.
+            early_left = self.window.time_to_end(now - self.start, len(self.questions))
+            if early_left is not None:
+                if early_left <= 0:
+                    self.ended_early = True
+                    break
+                time_left = min(time_left, early_left)
+            records = self.comm_queue.get_no_throw(True, time_left)
+            if records is not None:
+                self.consume_records(records)
 
+        elapsed = time.time() - self.start
+        self.window.update(len(self.questions), elapsed)
         self.logger.info(
-            "Stopped collecting questions, timestamp {}".format(self.stop))
-        for wss_pkg_payload in self.message_pool:
-            decompressed = gzip.decompress(wss_pkg_payload)
-            payload_pkg = Response()
-            payload_pkg.ParseFromString(decompressed)
-            for msg in payload_pkg.messagesList:
-                if msg.method == 'WebcastLikeMessage':
-                    pass
-                elif msg.method == 'WebcastMemberMessage':
-                    pass
-                elif msg.method == 'WebcastGiftMessage':
-                    pass
-                elif msg.method == 'WebcastChatMessage':
-                    message = ChatMessage()
-                    message.ParseFromString(msg.payload)
-                    text = message.content
-                    user_id = message.user.shortId
-                    event_time = message.eventTime
-                    self.logger.debug("msg: {}, uid: {}, timestamp: {}".format(
-                        text, user_id, event_time))
-                    if event_time >= self.start and event_time <= self.stop:
-                        self.add_question(user_id, text, event_time)
-                if msg.method == 'WebcastSocialMessage':
-                    pass
+            "Stopped collecting questions after {:.1f}s, {} questions{}".format(
+                elapsed, len(self.questions), ", ended early" if self.ended_early else ""))
+        self.window_chat_metric.observe(self.window_chat_count)
 
+        if self.batch_size > 1:
+            return self.select_batch()
         question = None
         if self.questions:
             question = self.checkout_question()
             self.logger.info("Selected question: {}".format(question))
-            self.collect_level = 0
+            self.discard_picked()
         else:
             self.logger.info("No question provided ...")
-            if random.uniform(0, 1) > 0.8:
-                question = random.sample(default_questions, k=1)
+            entry = self.backlog.pop() if self.backlog is not None else None
+            if entry is not None:
+                question = entry.question
+                self.logger.info("Pick from backlog ({} askers, {} left): {}".format(
+                    len(entry.user_ids), len(self.backlog), question))
+            elif random.uniform(0, 1) > 0.8:
+                question = random.choice(default_questions)
                 self.logger.info("Pick from default pool: {}".format(question))
-            if self.collect_level < len(self.collect_interval_levels) - 1:
-                self.collect_level += 1
+        if question:
+            self.selected_metric.inc()
         return question
 
-    def add_question(self, user_id, question, event_time):
-        if question.startswith(self.q_format):
-            question = question[len(self.q_format):].strip()
-            if question:
-                self.questions[user_id] = question
+    def select_batch(self):
+        picks = self.checkout_questions(self.batch_size)
+        if picks:
+            self.discard_picked()
+        if self.backlog is not None:
+            while len(picks) < self.batch_size:
+                entry = self.backlog.pop()
+                if entry is None:
+                    break
+                picks.append((next(iter(entry.user_ids)), entry.question))
+        if not picks:
+            self.logger.info("No question provided ...")
+            if random.uniform(0, 1) > 0.8:
+                self.selected_metric.inc()
+                return random.choice(default_questions)
+            return None
+        return self.batch_prompt(picks)
+
+    def batch_prompt(self, picks):
+        lines = []
+        length = len(self.batch_header)
+        for user_id, question in picks:
+            line = "{}. @{}: {}".format(
+                len(lines) + 1, self.askers.get(user_id) or user_id, question)
+            if lines and length + len(line) + 1 > self.max_prompt_chars:
+                # Doesn't fit this round, try again in a later one.
+                if self.backlog is not None:
+                    self.backlog.add(user_id, question)
+                continue
+            lines.append(line)
+            length += len(line) + 1
+        self.selected_metric.inc(len(lines))
+        self.logger.info("Selected {} questions:\n{}".format(len(lines), "\n".join(lines)))
+        if len(lines) == 1:
+            return picks[0][1]
+        self.batched = True
+        return self.batch_header + "\n".join(lines)
+
+    def consume_records(self, records, in_window=True):
+        for record in records:
+            if record.method == 'WebcastChatMessage':
+                self.logger.debug("msg: %s, uid: %s, timestamp: %s",
+                                  record.content, record.user_id, record.event_time)
+                if in_window and record.event_time >= self.start and record.event_time <= self.stop:
+                    self.window_chat_count += 1
+                    self.add_question(
+                        record.user_id, record.content, record.event_time, record.nickname)
+                elif self.backlog is not None:
+                    question = self.parse_question(record.content)
+                    if question:
+                        self.backlog.add(record.user_id, question)
+            elif self.backlog is not None:
+                self.backlog.add_activity(
+                    record.user_id, record.method, record.content)
+
+    def drain(self):
+        # Between windows: keep questions for the backlog instead of
+        # throwing them away with clear().
+        if self.backlog is None:
+            self.comm_queue.clear()
+            return
+        while True:
+            records = self.comm_queue.get_no_throw(False)
+            if records is None:
+                break
+            self.consume_records(records, in_window=False)
+
+    def parse_question(self, text):
+        if text.startswith(self.q_format):
+            return text[len(self.q_format):].strip()
+        return None
+
+    def reset_window(self):
+        self.questions.clear()
+        self.clusters.clear()
+        self.window_chat_count = 0
+
+    def add_question(self, user_id, question, event_time, nickname=None):
+        question = self.parse_question(question)
+        if question:
+            if nickname:
+                self.askers.pop(user_id, None)
+                self.askers[user_id] = nickname
+                if len(self.askers) > self.max_askers:
+                    self.askers.popitem(last=False)
+            self.questions.pop(user_id, None)
+            self.questions[user_id] = question
+            if self.selection == "cluster":
+                self.clusters.add(user_id, question)
+            if self.backlog is not None:
+                self.backlog.add(user_id, question)
+            if len(self.questions) > self.max_questions:
+                evicted_user_id, _ = self.questions.popitem(last=False)
+                self.clusters.remove(evicted_user_id)
 
     def checkout_question(self):
         questions = list(self.questions.values())
         self.logger.info("questions:\n" + "\n".join(questions))
-        question = random.sample(questions, k=1)
+        cluster = None
+        if self.selection == "cluster":
+            cluster = self.clusters.largest()
+        if cluster is not None:
+            self.logger.info("Largest cluster: {} of {} askers".format(
+                cluster.size, len(self.questions)))
+            questions = list(cluster.members.values())
+        question = random.choice(questions)
+        self.picked = questions if cluster is not None else [question]
         self.logger.info("Checked out question: {}".format(question))
         return question
 
+    def checkout_questions(self, k):
+        # (user_id, question) of up to k different questions
+        if self.selection == "cluster" and len(self.clusters):
+            picks = []
+            clusters = self.clusters.top(k)
+            for cluster in clusters:
+                user_id = random.choice(list(cluster.members))
+                picks.append((user_id, cluster.members[user_id]))
+            self.picked = [question for cluster in clusters
+                           for question in cluster.members.values()]
+            self.logger.info("Top clusters: {} of {} askers".format(
+                [cluster.size for cluster in clusters], len(self.questions)))
+            return picks
+        picks = random.sample(list(self.questions.items()), min(k, len(self.questions)))
+        self.picked = [question for _, question in picks]
+        return picks
+
+    def discard_picked(self):
+        # Every wording of a picked question is answered, none of them
+        # should come back from the backlog.
+        if self.backlog is not None:
+            for question in self.picked:
+                self.backlog.discard(question)
+
+
+def capture_path(capture_dir, live_url_id):
+    if not capture_dir:
+        return None
+    return os.path.join(capture_dir, "{}.cap".format(live_url_id))
+
+
+class RoomRecordRouter(object):
+    """Splits the shared wss queue into per-room views, so each room can be
+    fed to its own QuestionSelector. Every frame comes from a single room,
+    so routing is done per batch.
+    """
+
+    def __init__(self, comm_queue, max_pending=500, poll_sec=1):
+        self.comm_queue = comm_queue
+        self.max_pending = max_pending
+        # Longest blocking read, so a switched queue is picked up quickly.
+        self.poll_sec = poll_sec
+        self.next_queue = None
+        self.pending = {}
+
+    def room_queue(self, room):
+        if room not in self.pending:
+            self.pending[room] = deque(maxlen=self.max_pending)
+        return RoomQueue(self, room)
+
+    def route(self, records):
+        # Every room of the worker gets its room_queue() before reading
+        # starts, records of any other room are not ours.
+        pending = self.pending.get(records[0].room)
+        if pending is not None:
+            pending.append(records)
+
+    def get(self, room, block=True, timeout=None):
+        pending = self.pending[room]
+        if not block:
+            self.route_ready()
+            return pending.popleft() if pending else None
+        deadline = None if timeout is None else time.time() + timeout
+        while not pending:
+            self.take_next_queue()
+            time_left = None if deadline is None else deadline - time.time()
+            if time_left is not None and time_left <= 0:
+                return None
+            records = self.comm_queue.get_no_throw(
+                True, self.poll_sec if time_left is None else min(time_left, self.poll_sec))
+            if records is not None:
+                self.route(records)
+        return pending.popleft()
+
+    def switch_queue(self, comm_queue):
+        # Called from another thread, the reading thread moves over to
+        # comm_queue on its next read and releases the old queue.
+        self.next_queue = comm_queue
+
+    def take_next_queue(self):
+        comm_queue = self.next_queue
+        if comm_queue is not None:
+            self.next_queue = None
+            self.comm_queue.release()
+            self.comm_queue = comm_queue
+
+    def release(self):
+        self.comm_queue.release()
+        if self.next_queue is not None:
+            self.next_queue.release()
+
+    def clear(self, room):
+        self.take_next_queue()
+        if len(self.pending) == 1:
+            # Only one room, everything queued is ours to drop.
+            self.comm_queue.clear()
+            self.pending[room].clear()
+            return
+        self.route_ready()
+        self.pending[room].clear()
+
+    def route_ready(self):
+        # Routes whatever the comm_queue holds right now, without waiting.
+        self.take_next_queue()
+        while True:
+            records = self.comm_queue.get_no_throw(False)
+            if records is None:
+                break
+            self.route(records)
+
+
+class RoomQueue(object):
+    def __init__(self, router, room):
+        self.router = router
+        self.room = room
+
+    def get_no_throw(self, block=True, timeout=None):
+        return self.router.get(self.room, block, timeout)
+
+    def clear(self):
+        self.router.clear(self.room)
+
 
 class DouyinLiveWebSocketServer(object):
-    def __init__(self, live_url_id, comm_queue, log_path=None, log_level=logging.INFO) -> None:
-        if not log_path:
-            self.logger = create_logger(
-                "douyin_live_web_socket_server", log_level=log_level)
-        else:
-            self.logger = create_logger(
-                "douyin_live_web_socket_server", log_file_path=log_path, log_level=log_level)
+    """wss client of one live room.
+
+    A connection without any frame for frame_timeout_sec counts as dead.
+    Dead or failed connections are retried with jittered exponential
+    backoff, handing records to the same comm_queue all along. ready_event
+    (a multiprocessing.Event) is set on the first frame, heartbeat (a
+    shared timestamp, see WorkerSupervisor) on every frame and reconnect
+    attempt.
+    """
+
+    def __init__(self, live_url_id, comm_queue, log_path=None, log_level=logging.INFO, logger=None, record_path=None,
+                 handoff=None, overflow_policy="drop_oldest", frame_timeout_sec=30,
+                 resolver=None, ready_event=None, heartbeat=None) -> None:
+        if not logger:
+            if not log_path:
+                logger = create_logger(
+                    "douyin_live_web_socket_server", log_level=log_level)
+            else:
+                logger = create_logger(
+                    "douyin_live_web_socket_server", log_file_path=log_path, log_level=log_level)
+        # Tags every record with the room, rooms of a pool share one logger.
+        self.logger = logging.LoggerAdapter(logger, {"room": live_url_id})
         self.comm_queue = comm_queue
+        # Never block the receive loop on a slow consumer.
+        if handoff is None:
+            handoff = RecordHandoff(
+                comm_queue, overflow_policy=overflow_policy, logger=self.logger)
+        self.handoff = handoff
+        self.frames_metric = metrics.counter(
+            "wss_frames_total", "PushFrames received")
+        self.decode_metric = metrics.histogram(
+            "wss_decode_seconds", "Time to decode a PushFrame into records")
+        self.reconnects_metric = metrics.counter(
+            "wss_reconnects_total", "wss connections lost and retried")
+        self.downtime_metric = metrics.counter(
+            "wss_downtime_seconds_total", "Time from losing a wss connection to the next frame")
+        self.frame_timeout_sec = frame_timeout_sec
+        if resolver is None:
+            resolver = RoomResolver(logger=self.logger)
+        self.resolver = resolver
+        self.ready_event = ready_event
+        self.heartbeat = heartbeat
+        self.backoff = Backoff()
+        self.last_frame_time = time.time()
+        self.disconnected_at = None
+        self.recorder = None
+        if record_path:
+            self.recorder = FrameRecorder(record_path)
+            self.logger.info("Recording frames to {}".format(record_path))
 
+        self.live_url_id = live_url_id
         self.live_url = "https://live.douyin.com/{}".format(live_url_id)
         self.user_agent = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/108.0.0.0 Safari/537.36'
         self.live_req_header = {
@@ -152,81 +678,300 @@ class DouyinLiveWebSocketServer(object):
         #                       "browser_version=5.0%20(Macintosh;%20Intel%20Mac%20OS%20X%2010_15_7)%20AppleWebKit/537.36%20(KHTML,%20like%20Gecko)%20Chrome/108.0.0.0%20Safari/537.36"
         #                       "&browser_online=true&tz_name=Asia/Shanghai&identity=audience&room_id={}&heartbeatDuration=0")
 
-        self.web_socket_url = "wss://webcast3-ws-web-hl.douyin.com/webcast/im/push/v2/?app_name=douyin_web&version_code=180800&webcast_sdk_version=1.3.0&update_version_code=1.3.0&compress=gzip&internal_ext=internal_src:dim|wss_push_room_id:{}|wss_push_did:{}|dim_log_id:20230214220033B506EE3903790E3059C1|fetch_time:1676383233624|seq:1|wss_info:0-1676383233624-0-0|wrds_kvs:WebcastRoomRankMessage-1676382424986905036_WebcastRoomStatsMessage-1676383228980195548&cursor=d-1_u-1_h-1_t-1676383233624_r-1&host=https://live.douyin.com&aid=6383&live_id=1&did_rule=3&debug=false&endpoint=live_pc&support_wrds=1&im_path=/webcast/im/fetch/&user_unique_id=7179057636167058979&device_platform=web&cookie_enabled=true&screen_width=1440&screen_height=900&browser_language=en&browser_platform=MacIntel&browser_name=Mozilla&browser_version=5.0%20(Macintosh;%20Intel%20Mac%20OS%20X%2010_15_7)%20AppleWebKit/537.36%20(KHTML,%20like%20Gecko)%20Chrome/110.0.0.0%20Safari/537.36&browser_online=true&tz_name=Asia/Shanghai&identity=audience&room_id={}&heartbeatDuration=0&signature=WgK6lxlg8whoRwCL"
+        self.web_socket_url_template = "wss://webcast3-ws-web-hl.douyin.com/webcast/im/push/v2/?app_name=douyin_web&version_code=180800&webcast_sdk_version=1.3.0&update_version_code=1.3.0&compress=gzip&internal_ext=internal_src:dim|wss_push_room_id:{}|wss_push_did:{}|dim_log_id:20230214220033B506EE3903790E3059C1|fetch_time:1676383233624|seq:1|wss_info:0-1676383233624-0-0|wrds_kvs:WebcastRoomRankMessage-1676382424986905036_WebcastRoomStatsMessage-1676383228980195548&cursor=d-1_u-1_h-1_t-1676383233624_r-1&host=https://live.douyin.com&aid=6383&live_id=1&did_rule=3&debug=false&endpoint=live_pc&support_wrds=1&im_path=/webcast/im/fetch/&user_unique_id=7179057636167058979&device_platform=web&cookie_enabled=true&screen_width=1440&screen_height=900&browser_language=en&browser_platform=MacIntel&browser_name=Mozilla&browser_version=5.0%20(Macintosh;%20Intel%20Mac%20OS%20X%2010_15_7)%20AppleWebKit/537.36%20(KHTML,%20like%20Gecko)%20Chrome/110.0.0.0%20Safari/537.36&browser_online=true&tz_name=Asia/Shanghai&identity=audience&room_id={}&heartbeatDuration=0&signature=WgK6lxlg8whoRwCL"
 
-    def run_forever(self):
+    def resolve_room(self):
         self.logger.info("Connecting to {}".format(self.live_url))
 
-        res = requests.get(url=self.live_url, headers=self.live_req_header)
-        data = res.cookies.get_dict()
-        self.ttwid = data['ttwid']
-        res = res.text
-        res = re.search(
-            r'<script id="RENDER_DATA" type="application/json">(.*?)</script>', res)
-        res = res.group(1)
-        res = urllib.parse.unquote(res, encoding='utf-8', errors='replace')
-        res = json.loads(res)
-        self.live_room_id = res['app']['initialState']['roomStore']['roomInfo']['roomId']
+        # The cached room is tried once more after a drop, then refetched.
+        self.live_room_id, self.ttwid = self.resolver.resolve(
+            self.live_url_id, self.live_req_header, refresh=self.backoff.attempts > 1)
         self.logger.info("live_room_id: {}, ttwid {}".format(
             self.live_room_id, self.ttwid))
 
-        self.web_socket_url = self.web_socket_url.format(
+        self.web_socket_url = self.web_socket_url_template.format(
             self.live_room_id, self.live_room_id, self.live_room_id)
-
-        websocket.enableTrace(False)
         self.ws_header = {
             'cookie': "ttwid={}".format(self.ttwid),
             'user-agent': self.user_agent
         }
+
+    def run_forever(self):
+        websocket.enableTrace(False)
+        while True:
+            self.beat()
+            try:
+                self.resolve_room()
+                self.logger.info("Connecting to wss {}".format(self.web_socket_url))
+                self.ws_app = websocket.WebSocketApp(
+                    self.web_socket_url,
+                    on_open=self.on_open,
+                    on_message=self.on_message,
+                    on_error=self.on_error,
+                    on_close=self.on_close,
+                    header=self.ws_header
+                )
+                self.ws_app.run_forever()
+            except Exception as e:
+                self.logger.error("wss connection failed: {}".format(str(e)))
+            self.mark_disconnected()
+            delay = self.backoff.next_delay()
+            self.logger.info("Reconnecting in {:.1f}s ...".format(delay))
+            time.sleep(delay)
+
+    def run_async(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        if ws_connect is None:
+            raise RuntimeError(
+                "asyncio wss client requires the 'websockets' package")
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        while not self.stop_event.is_set():
+            self.beat()
+            try:
+                await self.serve_connection()
+            except Exception as e:
+                self.logger.error("wss connection failed: {}".format(str(e)))
+            if self.stop_event.is_set():
+                break
+            self.mark_disconnected()
+            delay = self.backoff.next_delay()
+            self.logger.info("Reconnecting in {:.1f}s ...".format(delay))
+            try:
+                await asyncio.wait_for(self.stop_event.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def serve_connection(self):
+        await self.loop.run_in_executor(None, self.resolve_room)
+
         self.logger.info("Connecting to wss {}".format(self.web_socket_url))
+        connect_kwargs = {WS_HEADER_KWARG: self.ws_header, "max_size": None}
+        async with ws_connect(self.web_socket_url, **connect_kwargs) as ws:
+            self.logger.info("websocket opened")
+            self.last_frame_time = time.time()
+            tasks = [asyncio.create_task(self.receive_loop(ws)),
+                     asyncio.create_task(self.heartbeat_loop(ws)),
+                     asyncio.create_task(self.frame_watchdog()),
+                     asyncio.create_task(self.stop_event.wait())]
+            try:
+                done, _ = await asyncio.wait(
+                    tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if not task.cancelled() and task.exception() is not None:
+                        self.on_error(ws, task.exception())
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                if self.recorder is not None:
+                    self.recorder.flush()
+        self.logger.error("websocket closing ...")
+
+    def run_replay(self, path, speed=1.0):
+        asyncio.run(self.replay(path, speed))
+
+    async def replay(self, path, speed=1.0):
+        # Feeds a capture through handle_frame as if it came from the wire.
+        reader = FrameReader(path)
+        self.logger.info("Replaying {} frames from {} at speed {}".format(
+            len(reader), path, speed if speed > 0 else "max"))
+        start = time.time()
+        count = 0
+        for delay, frame_bytes in replay_schedule(reader.frames(), speed):
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.handle_frame(frame_bytes)
+            count += 1
+        elapsed = time.time() - start
+        self.logger.info("Replayed {} frames in {:.2f}s ({:.1f} frames/s)".format(
+            count, elapsed, count / elapsed if elapsed > 0 else 0))
+
+    def stop(self):
+        # Safe to call from any thread while serve() is running.
+        self.loop.call_soon_threadsafe(self.stop_event.set)
+
+    def close(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    async def receive_loop(self, ws):
+        async for message in ws:
+            ack = self.handle_frame(message)
+            if ack is not None:
+                await ws.send(ack)
+
+    async def frame_watchdog(self):
+        while True:
+            await asyncio.sleep(1)
+            if self.frame_gap_exceeded():
+                return
 
-        self.ws_app = websocket.WebSocketApp(
-            self.web_socket_url,
-            on_open=self.on_open,
-            on_message=self.on_message,
-            on_error=self.on_error,
-            on_close=self.on_close,
-            header=self.ws_header
-        )
-        self.ws_app.run_forever()
-
-    def sendAck(self, ws, logId, internalExt):
+    def frame_gap_exceeded(self):
+        gap = time.time() - self.last_frame_time
+        if gap > self.frame_timeout_sec:
+            self.logger.error("No frame for {:.0f}s, connection is dead".format(gap))
+            return True
+        return False
+
+    def mark_disconnected(self):
+        if self.disconnected_at is None:
+            self.disconnected_at = time.time()
+        self.reconnects_metric.inc(labels={"room": self.live_url_id})
+
+    def beat(self):
+        if self.heartbeat is not None:
+            self.heartbeat.value = time.time()
+
+    def mark_frame(self):
+        self.last_frame_time = time.time()
+        self.beat()
+        if self.ready_event is not None:
+            self.ready_event.set()
+            self.ready_event = None
+        if self.disconnected_at is not None:
+            downtime = self.last_frame_time - self.disconnected_at
+            self.disconnected_at = None
+            self.backoff.reset()
+            self.downtime_metric.inc(downtime, labels={"room": self.live_url_id})
+            self.logger.info("Frames are back after {:.1f}s".format(downtime))
+
+    async def heartbeat_loop(self, ws):
+        while True:
+            await ws.send(self.build_heartbeat())
+            self.handoff.flush()
+            if self.recorder is not None:
+                self.recorder.flush()
+            await asyncio.sleep(10)
+
+    def build_ack(self, logId, internalExt):
         obj = PushFrame()
         obj.payloadType = 'ack'
         obj.logId = logId
         obj.payloadType = internalExt
-        data = obj.SerializeToString()
-        ws.send(data, websocket.ABNF.OPCODE_BINARY)
+        return obj.SerializeToString()
 
-    def on_message(self, ws: websocket.WebSocketApp, message: bytes):
-        self.logger.debug(
-            "Recieved new packages {} bytes".format(len(message)))
-        wssPackage = PushFrame()
-        wssPackage.ParseFromString(message)
-        logId = wssPackage.logId
+    def build_heartbeat(self):
+        obj = PushFrame()
+        obj.payloadType = 'hb'
+        return obj.SerializeToString()
 
-        self.comm_queue.put(wssPackage.payload)
+    def handle_frame(self, message):
+        # Decode once, hand records over, and return the ack frame if needed.
+        self.logger.debug("Recieved new packages %d bytes", len(message))
+        self.mark_frame()
+        if self.recorder is not None:
+            self.recorder.write(message)
+        decode_start = time.perf_counter()
+        wssPackage, payloadPackage, records = decode_push_frame(
+            message, self.live_url_id)
+        self.decode_metric.observe(time.perf_counter() - decode_start)
+        self.frames_metric.inc(labels={"room": self.live_url_id})
+
+        if records:
+            self.handoff.put(records)
 
-        decompressed = gzip.decompress(wssPackage.payload)
-        payloadPackage = Response()
-        payloadPackage.ParseFromString(decompressed)
         # 发送ack包
         if payloadPackage.needAck:
-            self.sendAck(ws, logId, payloadPackage.internalExt)
+            return self.build_ack(wssPackage.logId, payloadPackage.internalExt)
+        return None
+
+    def on_message(self, ws: websocket.WebSocketApp, message: bytes):
+        ack = self.handle_frame(message)
+        if ack is not None:
+            ws.send(ack, websocket.ABNF.OPCODE_BINARY)
 
     def ping(self, ws):
-        while True:
-            obj = PushFrame()
-            obj.payloadType = 'hb'
-            data = obj.SerializeToString()
-            ws.send(data, websocket.ABNF.OPCODE_BINARY)
+        while ws.keep_running:
+            if self.frame_gap_exceeded():
+                ws.close()
+                return
+            ws.send(self.build_heartbeat(), websocket.ABNF.OPCODE_BINARY)
+            if self.recorder is not None:
+                self.recorder.flush()
             time.sleep(10)
 
     def on_open(self, ws):
+        self.last_frame_time = time.time()
         _thread.start_new_thread(self.ping, (ws,))
 
     def on_error(self, ws, error):
         self.logger.error("websocket error: {}".format(str(error)))
 
     def on_close(self, ws, a, b):
+        if self.recorder is not None:
+            self.recorder.flush()
         self.logger.error("websocket closing ...")
+
+
+class DouyinLiveRoomPool(object):
+    """Holds the wss connections of several live rooms in one event loop,
+    all feeding the same comm_queue with room-tagged records. It always
+    uses the asyncio client, whatever --wss_client says.
+    """
+
+    def __init__(self, live_url_ids, comm_queue, log_path=None, log_level=logging.INFO,
+                 record_dir=None, replay_dir=None, replay_speed=1.0,
+                 overflow_policy="drop_oldest", ready_event=None, heartbeat=None) -> None:
+        if not log_path:
+            self.logger = create_logger(
+                "douyin_live_room_pool", log_level=log_level)
+        else:
+            self.logger = create_logger(
+                "douyin_live_room_pool", log_file_path=log_path, log_level=log_level)
+        self.comm_queue = comm_queue
+        # One hand-off buffer for all rooms, they share the comm_queue.
+        self.handoff = RecordHandoff(
+            comm_queue, overflow_policy=overflow_policy, logger=self.logger)
+        self.record_dir = record_dir
+        self.replay_dir = replay_dir
+        self.replay_speed = replay_speed
+        if ws_connect is None and not replay_dir:
+            raise RuntimeError(
+                "serving several live rooms requires the 'websockets' package")
+        self.resolver = RoomResolver(logger=self.logger)
+        self.ready_event = ready_event
+        # Rooms are fixed at startup, the main process routes records by
+        # these IDs.
+        self.servers = {}
+        for live_url_id in live_url_ids:
+            self.servers[live_url_id] = DouyinLiveWebSocketServer(
+                live_url_id, comm_queue, logger=self.logger,
+                record_path=capture_path(record_dir, live_url_id),
+                handoff=self.handoff, resolver=self.resolver,
+                ready_event=ready_event, heartbeat=heartbeat)
+        self.tasks = {}
+        self.loop = None
+
+    def start_server(self, live_url_id):
+        server = self.servers[live_url_id]
+        if self.replay_dir:
+            coro = server.replay(capture_path(
+                self.replay_dir, live_url_id), self.replay_speed)
+        else:
+            coro = server.serve()
+        self.tasks[live_url_id] = self.loop.create_task(coro)
+
+    def close(self):
+        for server in self.servers.values():
+            server.close()
+
+    def run_async(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        for live_url_id in list(self.servers):
+            self.start_server(live_url_id)
+        while self.tasks:
+            done, _ = await asyncio.wait(
+                list(self.tasks.values()), return_when=asyncio.FIRST_COMPLETED)
+            for live_url_id, task in list(self.tasks.items()):
+                if task in done:
+                    del self.tasks[live_url_id]
+                    if not task.cancelled() and task.exception() is not None:
+                        self.logger.error("room {} stopped: {}".format(
+                            live_url_id, str(task.exception())))
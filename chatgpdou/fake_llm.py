@@ -0,0 +1,106 @@
+import json
+import time
+import random
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeChatCompletionsServer(object):
+    """Local stand-in for an OpenAI-style /v1/chat/completions endpoint.
+
+    Streams a canned answer as server-sent events after first_token_delay
+    seconds, at chars_per_sec, so the HTTP backend can be load tested
+    without the network. Non-streaming requests get the whole answer.
+    """
+
+    def __init__(self, port=8001, host="127.0.0.1", first_token_delay=0.5,
+                 chars_per_sec=40, answer_chars=300):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    self.send_error(404)
+                    return
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                question = body["messages"][-1]["content"]
+                answer = server.answer_for(question)
+                if body.get("stream"):
+                    server.stream(self, answer)
+                else:
+                    payload = json.dumps({"choices": [{
+                        "index": 0, "finish_reason": "stop",
+                        "message": {"role": "assistant", "content": answer}}]}).encode("utf-8")
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/json; charset=utf-8")
+                    self.send_header("Content-Length", str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.first_token_delay = first_token_delay
+        self.chars_per_sec = chars_per_sec
+        self.answer_chars = answer_chars
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+
+    def answer_for(self, question):
+        words = "这是一个关于{}的回答。".format(question)
+        return (words * (self.answer_chars // len(words) + 1))[:self.answer_chars]
+
+    def stream(self, handler, answer, chunk_chars=4):
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        handler.send_header("Transfer-Encoding", "chunked")
+        handler.end_headers()
+
+        def send_event(data):
+            event = "data: {}\n\n".format(data).encode("utf-8")
+            handler.wfile.write("{:x}\r\n".format(len(event)).encode("ascii") + event + b"\r\n")
+            handler.wfile.flush()
+
+        time.sleep(self.first_token_delay * random.uniform(0.5, 1.5))
+        for start in range(0, len(answer), chunk_chars):
+            delta = answer[start:start + chunk_chars]
+            send_event(json.dumps({"choices": [{
+                "index": 0, "delta": {"content": delta}, "finish_reason": None}]},
+                ensure_ascii=False))
+            time.sleep(len(delta) / self.chars_per_sec)
+        send_event(json.dumps({"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}))
+        send_event("[DONE]")
+        handler.wfile.write(b"0\r\n\r\n")
+        handler.wfile.flush()
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Local stand-in chat completions server, '
+                    'use with --backend http --api_url http://127.0.0.1:<port>/v1')
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--first_token_delay", type=float, default=0.5)
+    parser.add_argument("--chars_per_sec", type=float, default=40)
+    parser.add_argument("--answer_chars", type=int, default=300)
+    args = parser.parse_args()
+    server = FakeChatCompletionsServer(args.port, first_token_delay=args.first_token_delay,
+                                       chars_per_sec=args.chars_per_sec,
+                                       answer_chars=args.answer_chars)
+    print("Serving http://127.0.0.1:{}/v1/chat/completions".format(args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
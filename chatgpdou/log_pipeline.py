@@ -0,0 +1,75 @@
+import os
+import json
+import signal
+import logging
+import multiprocessing
+from logging.handlers import QueueListener, RotatingFileHandler
+
+
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "process": getattr(record, "process_tag", None),
+            "room": getattr(record, "room", None),
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class ConsoleFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s [%(levelname)-5.5s] %(tag)s %(message)s",
+                         datefmt="%Y-%m-%d %H:%M:%S")
+
+    def format(self, record):
+        tag = getattr(record, "process_tag", None) or record.processName
+        room = getattr(record, "room", None)
+        record.tag = "{}/{}".format(tag, room) if room is not None else tag
+        return super().format(record)
+
+
+def log_writer(log_queue, stop_event, log_dir, max_bytes, backup_count):
+    # Ctrl-C goes to the whole process group; keep writing until the main
+    # process is done and asks us to stop.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(ConsoleFormatter())
+    file_handler = RotatingFileHandler(
+        os.path.join(log_dir, "chatgpdou.jsonl"), maxBytes=max_bytes,
+        backupCount=backup_count, encoding="utf-8")
+    file_handler.setFormatter(JsonLinesFormatter())
+    listener = QueueListener(log_queue, console_handler, file_handler)
+    listener.start()
+    stop_event.wait()
+    listener.stop()
+    file_handler.close()
+
+
+class LogPipeline(object):
+    """Single writer process for the logs of every process.
+
+    Loggers only put records on a multiprocessing queue (see
+    chatgpdou.use_log_queue), so neither disk nor console I/O runs on the
+    frame handling path. The writer keeps one ordered stream, written to
+    the console and to <log_dir>/chatgpdou.jsonl, one JSON record per line
+    with process and room tags, rotated every max_bytes.
+    """
+
+    def __init__(self, log_dir, max_bytes=20 * 1024 * 1024, backup_count=5):
+        ctx = multiprocessing.get_context()
+        self.queue = ctx.Queue()
+        self.stop_event = ctx.Event()
+        self.process = ctx.Process(
+            target=log_writer, name="log_writer", daemon=True,
+            args=(self.queue, self.stop_event, log_dir, max_bytes, backup_count))
+
+    def start(self):
+        self.process.start()
+        return self
+
+    def stop(self, timeout=10):
+        self.stop_event.set()
+        self.process.join(timeout)
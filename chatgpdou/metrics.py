@@ -0,0 +1,249 @@
+import os
+import json
+import time
+import glob
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60, 120)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+class Counter(object):
+    kind = "counter"
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, value=1, labels=None):
+        key = label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def snapshot(self):
+        with self.lock:
+            return [{"labels": dict(key), "value": value}
+                    for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, labels=None):
+        with self.lock:
+            self.values[label_key(labels)] = value
+
+
+class Histogram(object):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[idx] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {"buckets": list(self.buckets), "counts": list(self.counts),
+                    "sum": self.sum, "count": self.count}
+
+
+class MetricsRegistry(object):
+    """Counters, gauges and histograms of one process.
+
+    snapshot() is plain JSON, so every process can flush it to a stats file
+    in the session log folder; the main process renders all of them in the
+    Prometheus text format, tagged with the process they came from.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.last_totals = {}
+        self.last_snapshot = time.time()
+
+    def get_or_create(self, cls, name, help_text, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = cls(name, help_text, **kwargs)
+                self.metrics[name] = metric
+            return metric
+
+    def counter(self, name, help_text=""):
+        return self.get_or_create(Counter, name, help_text)
+
+    def gauge(self, name, help_text=""):
+        return self.get_or_create(Gauge, name, help_text)
+
+    def histogram(self, name, help_text="", buckets=LATENCY_BUCKETS):
+        return self.get_or_create(Histogram, name, help_text, buckets=buckets)
+
+    def snapshot(self):
+        now = time.time()
+        elapsed = max(now - self.last_snapshot, 1e-6)
+        self.last_snapshot = now
+        result = {"time": now, "metrics": {}}
+        with self.lock:
+            metrics = list(self.metrics.values())
+        for metric in metrics:
+            entry = {"kind": metric.kind, "help": metric.help,
+                     "data": metric.snapshot()}
+            if metric.kind == "counter":
+                # Per second rate since the previous snapshot, e.g. frames/s.
+                total = sum(sample["value"] for sample in entry["data"])
+                entry["rate"] = (total - self.last_totals.get(metric.name, 0)) / elapsed
+                self.last_totals[metric.name] = total
+            result["metrics"][metric.name] = entry
+        return result
+
+
+# Process wide registry
+metrics = MetricsRegistry()
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, str(value).replace('"', '\\"'))
+                          for key, value in sorted(labels.items())) + "}"
+
+
+def render_prometheus(snapshots):
+    # snapshots: {process name: registry snapshot}. Samples of one metric
+    # are kept together across processes, as the text format expects.
+    names = sorted(set(name for snapshot in snapshots.values()
+                       for name in snapshot["metrics"]))
+    lines = []
+    for name in names:
+        entries = [(process, snapshot["metrics"][name])
+                   for process, snapshot in sorted(snapshots.items())
+                   if name in snapshot["metrics"]]
+        lines.append("# HELP {} {}".format(name, entries[0][1]["help"]))
+        lines.append("# TYPE {} {}".format(name, entries[0][1]["kind"]))
+        for process, entry in entries:
+            if entry["kind"] == "histogram":
+                data = entry["data"]
+                cumulative = 0
+                for bound, count in zip(data["buckets"] + ["+Inf"], data["counts"]):
+                    cumulative += count
+                    lines.append("{}_bucket{} {}".format(
+                        name, format_labels({"process": process, "le": bound}), cumulative))
+                lines.append("{}_sum{} {}".format(
+                    name, format_labels({"process": process}), data["sum"]))
+                lines.append("{}_count{} {}".format(
+                    name, format_labels({"process": process}), data["count"]))
+            else:
+                for sample in entry["data"]:
+                    labels = dict(sample["labels"], process=process)
+                    lines.append("{}{} {}".format(
+                        name, format_labels(labels), sample["value"]))
+        rates = [(process, entry["rate"]) for process, entry in entries if "rate" in entry]
+        if rates:
+            lines.append("# TYPE {}_per_second gauge".format(name))
+            for process, rate in rates:
+                lines.append("{}_per_second{} {}".format(
+                    name, format_labels({"process": process}), rate))
+    return "\n".join(lines) + "\n"
+
+
+def stats_file_path(stats_dir, process):
+    return os.path.join(stats_dir, "metrics_{}.json".format(process))
+
+
+def load_snapshots(stats_dir):
+    snapshots = {}
+    for path in glob.glob(os.path.join(stats_dir, "metrics_*.json")):
+        process = os.path.basename(path)[len("metrics_"):-len(".json")]
+        try:
+            with open(path, encoding="utf-8") as stats_file:
+                snapshots[process] = json.load(stats_file)
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+class MetricsFlusher(object):
+    """Writes the registry snapshot of this process to
+    <stats_dir>/metrics_<process>.json every interval seconds."""
+
+    def __init__(self, stats_dir, process, interval=10, registry=metrics):
+        self.path = stats_file_path(stats_dir, process)
+        self.interval = interval
+        self.registry = registry
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name="metrics_flusher")
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as stats_file:
+            json.dump(self.registry.snapshot(), stats_file)
+        os.replace(tmp_path, self.path)
+
+    def stop(self):
+        self.stopped.set()
+        self.flush()
+
+
+class MetricsHTTPServer(object):
+    """Serves /metrics in the Prometheus text format on localhost, with the
+    stats files of every process in stats_dir."""
+
+    def __init__(self, stats_dir, port, host="127.0.0.1"):
+        stats = stats_dir
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = render_prometheus(load_snapshots(stats)).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True, name="metrics_http")
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,133 @@
+import os
+import sys
+import glob
+import time
+import argparse
+import threading
+import tracemalloc
+from collections import Counter
+
+
+class Profiler(object):
+    """Sampling CPU profiler plus tracemalloc snapshots for one process.
+
+    A daemon thread samples the stacks of all other threads every
+    sample_interval seconds. Every interval_min minutes the collected stacks
+    are written as <process>_cpu_<time>.folded (collapsed stacks, usable by
+    flamegraph tools) next to a <process>_mem_<time>.tracemalloc snapshot,
+    keeping the newest `keep` of each.
+    """
+
+    def __init__(self, out_dir, process, interval_min=5, sample_interval=0.01,
+                 keep=12, trace_frames=10):
+        os.makedirs(out_dir, exist_ok=True)
+        self.out_dir = out_dir
+        self.process = process
+        self.interval_sec = interval_min * 60
+        self.sample_interval = sample_interval
+        self.keep = keep
+        self.trace_frames = trace_frames
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name="profiler")
+
+    def start(self):
+        tracemalloc.start(self.trace_frames)
+        self.thread.start()
+        return self
+
+    def run(self):
+        own_id = threading.get_ident()
+        next_dump = time.time() + self.interval_sec
+        while not self.stopped.wait(self.sample_interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    self.stacks[self.collapse(frame)] += 1
+            if time.time() >= next_dump:
+                self.dump()
+                next_dump = time.time() + self.interval_sec
+
+    def collapse(self, frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append("{}:{}:{}".format(
+                os.path.basename(code.co_filename), code.co_name, frame.f_lineno))
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def dump(self):
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        stacks, self.stacks = self.stacks, Counter()
+        cpu_path = os.path.join(self.out_dir, "{}_cpu_{}.folded".format(self.process, stamp))
+        with open(cpu_path, "w", encoding="utf-8") as cpu_file:
+            for stack, count in stacks.most_common():
+                cpu_file.write("{} {}\n".format(stack, count))
+        tracemalloc.take_snapshot().dump(os.path.join(
+            self.out_dir, "{}_mem_{}.tracemalloc".format(self.process, stamp)))
+        self.rotate("cpu", "folded")
+        self.rotate("mem", "tracemalloc")
+
+    def rotate(self, kind, ext):
+        paths = sorted(glob.glob(os.path.join(
+            self.out_dir, "{}_{}_*.{}".format(self.process, kind, ext))))
+        for path in paths[:-self.keep]:
+            os.remove(path)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.dump()
+        tracemalloc.stop()
+
+
+def top_functions(folded_path, limit=20):
+    # Self time per function (leaf frame) from a .folded file.
+    leafs = Counter()
+    total = 0
+    with open(folded_path, encoding="utf-8") as folded_file:
+        for line in folded_file:
+            stack, count = line.rstrip("\n").rsplit(" ", 1)
+            leaf = stack.rsplit(";", 1)[-1].rsplit(":", 1)[0]
+            leafs[leaf] += int(count)
+            total += int(count)
+    return total, leafs.most_common(limit)
+
+
+def report(profile_dir, process, limit=20):
+    cpu_paths = sorted(glob.glob(os.path.join(profile_dir, "{}_cpu_*.folded".format(process))))
+    mem_paths = sorted(glob.glob(os.path.join(profile_dir, "{}_mem_*.tracemalloc".format(process))))
+    if cpu_paths:
+        total, top = top_functions(cpu_paths[-1], limit)
+        print("== {} CPU, {} samples in {}".format(process, total, os.path.basename(cpu_paths[-1])))
+        for func, count in top:
+            print("{:6.1f}%  {}".format(100.0 * count / total if total else 0, func))
+    if len(mem_paths) >= 2:
+        old = tracemalloc.Snapshot.load(mem_paths[0])
+        new = tracemalloc.Snapshot.load(mem_paths[-1])
+        print("== {} memory growth {} -> {}".format(
+            process, os.path.basename(mem_paths[0]), os.path.basename(mem_paths[-1])))
+        for stat in new.compare_to(old, "lineno")[:limit]:
+            print(stat)
+    elif mem_paths:
+        print("== {} memory, only one snapshot: {}".format(process, os.path.basename(mem_paths[0])))
+        for stat in tracemalloc.Snapshot.load(mem_paths[0]).statistics("lineno")[:limit]:
+            print(stat)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Report CPU hot spots and memory growth from --profile output')
+    parser.add_argument("profile_dir",
+                        help="the profile folder inside a session log folder")
+    parser.add_argument("--process", type=str, nargs='*',
+                        default=["main", "wss_worker"])
+    parser.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+    for process in args.process:
+        report(args.profile_dir, process, args.limit)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import os
+import re
+import json
+import time
+import threading
+import urllib.parse
+
+import requests
+
+from chatgpdou import create_logger
+from chatgpdou import CACHE_DIR
+
+
+class RoomResolver(object):
+    """live url ID -> (room ID, ttwid), with a TTL cache persisted in
+    cache_path so reconnects and restarts skip the live page.
+
+    Pages are fetched through one keep-alive session and only read up to
+    the roomId of roomInfo, falling back to parsing the whole RENDER_DATA
+    when the page layout changes. The rest of the page is read off the
+    resolving path, so the connection goes back to the pool.
+    """
+    room_info_marker = b"%22roomInfo%22"
+    room_id_pattern = re.compile(rb"%22roomId%22%3A%22(\d+)%22")
+    render_data_pattern = re.compile(
+        r'<script id="RENDER_DATA" type="application/json">(.*?)</script>')
+
+    def __init__(self, cache_path=os.path.join(CACHE_DIR, "rooms.json"),
+                 ttl_sec=6 * 3600, logger=None):
+        if not logger:
+            self.logger = create_logger("room_resolver")
+        else:
+            self.logger = logger
+        self.cache_path = cache_path
+        self.ttl_sec = ttl_sec
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        self.rooms = self.load()
+
+    def load(self):
+        try:
+            with open(self.cache_path, encoding="utf-8") as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok=True)
+        tmp_path = self.cache_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as cache_file:
+            json.dump(self.rooms, cache_file)
+        os.replace(tmp_path, self.cache_path)
+
+    def resolve(self, live_url_id, headers, refresh=False):
+        key = str(live_url_id)
+        with self.lock:
+            room = self.rooms.get(key)
+        if room is not None and not refresh and time.time() - room["resolved"] < self.ttl_sec:
+            return room["room_id"], room["ttwid"]
+
+        start = time.time()
+        room_id, ttwid = self.fetch("https://live.douyin.com/{}".format(live_url_id), headers)
+        self.logger.info("Resolved live {} in {:.2f}s".format(live_url_id, time.time() - start))
+        with self.lock:
+            self.rooms[key] = {"room_id": room_id, "ttwid": ttwid, "resolved": time.time()}
+            self.save()
+        return room_id, ttwid
+
+    def fetch(self, live_url, headers):
+        res = self.session.get(url=live_url, headers=headers, stream=True)
+        try:
+            ttwid = res.cookies.get_dict()['ttwid']
+            page = bytearray()
+            room_info_at = -1
+            for chunk in res.iter_content(chunk_size=16 * 1024):
+                scanned = max(0, len(page) - len(self.room_info_marker))
+                page += chunk
+                if room_info_at < 0:
+                    room_info_at = page.find(self.room_info_marker, scanned)
+                if room_info_at >= 0:
+                    match = self.room_id_pattern.search(page, room_info_at)
+                    if match:
+                        threading.Thread(target=self.discard_rest, args=(res,),
+                                         daemon=True, name="discard_live_page").start()
+                        res = None
+                        return match.group(1).decode("ascii"), ttwid
+            text = bytes(page).decode("utf-8", errors="replace")
+        finally:
+            if res is not None:
+                res.close()
+
+        self.logger.warning("roomId not found by the extractor, parsing RENDER_DATA")
+        render_data = self.render_data_pattern.search(text).group(1)
+        render_data = json.loads(urllib.parse.unquote(
+            render_data, encoding='utf-8', errors='replace'))
+        return render_data['app']['initialState']['roomStore']['roomInfo']['roomId'], ttwid
+
+    def discard_rest(self, res):
+        # Closing a half-read response closes its socket, a fully read one
+        # is returned to the session's pool.
+        try:
+            for _ in res.iter_content(chunk_size=64 * 1024):
+                pass
+        except requests.RequestException as e:
+            self.logger.debug("Discarding live page failed: {}".format(str(e)))
+        finally:
+            res.close()
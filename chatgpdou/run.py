@@ -1,32 +1,117 @@
 import os
 import argparse
+import threading
 import time
 import logging
 import multiprocessing
 from datetime import datetime
 
-from chatgpdou import create_logger
-from chatgpdou import LOG_DIR, WEB_DRIVER_DIR
+from chatgpdou import create_logger, use_log_queue
+from chatgpdou import LOG_DIR, WEB_DRIVER_DIR, CACHE_DIR
 from chatgpdou import create_or_clean_folder
-from chatgpdou.douyin import DouyinLiveWebSocketServer
 from chatgpdou.douyin import QuestionSelector
-from chatgpdou import CommunicationQueue
-from chatgpdou.chatgpt import ChatGPTWebBot
-
-
-def wss_worker(live_url_id, comm_queue, log_path, log_level):
-    wss_server = DouyinLiveWebSocketServer(
-        live_url_id, comm_queue, log_path=log_path, log_level=log_level)
-    wss_server.run_forever()
+from chatgpdou.douyin import AdaptiveWindow
+from chatgpdou.douyin import RoomRecordRouter
+from chatgpdou.douyin import RecordHandoff
+from chatgpdou.douyin import ws_connect
+from chatgpdou import create_comm_queue
+from chatgpdou.scheduler import BotScheduler
+from chatgpdou.answer_cache import AnswerCache
+from chatgpdou.backlog import QuestionBacklog
+from chatgpdou.transcript import AnswerTranscript
+from chatgpdou.metrics import MetricsFlusher, MetricsHTTPServer
+from chatgpdou.supervisor import WorkerSupervisor
+from chatgpdou.profiling import Profiler
+from chatgpdou.log_pipeline import LogPipeline
+from chatgpdou.wss_worker import wss_worker
 
 
 def main():
     parser = argparse.ArgumentParser(description='ChatGPDou')
-    parser.add_argument("live_url_id", nargs='?')
+    parser.add_argument("live_url_ids", nargs='*',
+                        help="one or more live url IDs, served by a single wss worker")
     parser.add_argument("--web_bot_num", type=int, default=1)
+    parser.add_argument("--backend", type=str,
+                        choices=["web", "http"], default="web",
+                        help="answer with the ChatGPT web page, or an OpenAI-style streaming API "
+                             "with the web bots only showing the answers")
+    parser.add_argument("--api_url", type=str, default="https://api.openai.com/v1",
+                        help="see python -m chatgpdou.fake_llm for a local stand-in")
+    parser.add_argument("--api_model", type=str, default="gpt-3.5-turbo")
+    parser.add_argument("--api_key_env", type=str, default="OPENAI_API_KEY",
+                        help="environment variable holding the API key")
+    parser.add_argument("--http_concurrency", type=int, default=4,
+                        help="answers streamed at the same time by the http backend")
+    parser.add_argument("--standby_browsers", type=int, default=0,
+                        help="warm browsers, using the next user_data_N profiles, "
+                             "that replace broken web bots, 0 = none")
+    parser.add_argument("--unattended", action="store_true",
+                        help="no prompts, wait for the chat pages and the first wss frame instead, "
+                             "and exit with an error when they don't come")
+    parser.add_argument("--page_ready_timeout_sec", type=int, default=120)
+    parser.add_argument("--wss_ready_timeout_sec", type=int, default=30,
+                        help="time for the first wss frame before retrying the wss worker")
+    parser.add_argument("--wss_ready_retries", type=int, default=3)
     parser.add_argument("--log_level", type=str,
                         choices=["info", "debug"], default="info")
+    parser.add_argument("--transport", type=str,
+                        choices=["queue", "shm"], default="queue",
+                        help="wss worker -> main process transport")
+    parser.add_argument("--wss_client", type=str,
+                        choices=["thread", "asyncio"], default="thread",
+                        help="websocket-client with a ping thread, or an asyncio event loop")
+    parser.add_argument("--overflow_policy", type=str,
+                        choices=RecordHandoff.overflow_policies, default="drop_oldest",
+                        help="what the wss worker drops when the main process falls behind")
+    parser.add_argument("--record_dir", type=str, default=None,
+                        help="append raw wss frames of each room to <record_dir>/<live_url_id>.cap")
+    parser.add_argument("--replay_dir", type=str, default=None,
+                        help="replay <replay_dir>/<live_url_id>.cap instead of connecting")
+    parser.add_argument("--replay_speed", type=float, default=1.0,
+                        help="replay speed multiplier, 0 = as fast as possible")
+    parser.add_argument("--selection", type=str,
+                        choices=QuestionSelector.selections, default="cluster",
+                        help="ask the most asked question or a random one")
+    parser.add_argument("--window_min_sec", type=int, default=8)
+    parser.add_argument("--window_max_sec", type=int, default=40)
+    parser.add_argument("--window_target_questions", type=int, default=10,
+                        help="questions a collection window aims for, it ends early once they are in")
+    parser.add_argument("--batch_size", type=int, default=1,
+                        help="questions asked together in one numbered prompt per round")
+    parser.add_argument("--max_prompt_chars", type=int, default=500,
+                        help="length limit of a batched prompt")
+    parser.add_argument("--answer_timeout_sec", type=int, default=120)
+    parser.add_argument("--answer_cache", type=str,
+                        default=os.path.join(CACHE_DIR, "answers.sqlite"),
+                        help="sqlite file of cached answers, empty string to disable")
+    parser.add_argument("--answer_cache_size", type=int, default=5000)
+    parser.add_argument("--answer_cache_ttl_hours", type=float, default=72)
+    parser.add_argument("--backlog_size", type=int, default=2000,
+                        help="questions kept across rounds, 0 to discard unpicked questions")
+    parser.add_argument("--backlog_max_age_sec", type=int, default=600)
+    parser.add_argument("--max_in_flight", type=int, default=None,
+                        help="questions collected or answered at the same time, up to the number of web bots or --http_concurrency, "
+                             "defaults to --http_concurrency with --backend http, 1 otherwise")
+    parser.add_argument("--screen_policy", type=str,
+                        choices=BotScheduler.screen_policies, default="primed",
+                        help="which bot is brought to the foreground")
+    parser.add_argument("--metrics_port", type=int, default=0,
+                        help="serve Prometheus-style /metrics on localhost, 0 = stats files only")
+    parser.add_argument("--profile", action="store_true",
+                        help="sample CPU stacks and tracemalloc snapshots of both processes "
+                             "into <log dir>/profile, see python -m chatgpdou.profiling")
+    parser.add_argument("--profile_interval_min", type=float, default=5,
+                        help="minutes between profile files")
     args = parser.parse_args()
+    if args.unattended and not args.live_url_ids:
+        parser.error("--unattended needs the live url IDs")
+    if args.max_in_flight is None:
+        args.max_in_flight = args.http_concurrency if args.backend == "http" else 1
+
+    # Imported here, so a spawned wss worker re-running this module as
+    # __mp_main__ doesn't load selenium and undetected_chromedriver.
+    from chatgpdou.browser_pool import BrowserPool, launch_web_bots, prepare_web_bots
+    from chatgpdou.backends import HTTPStreamingBackend, create_http_session
 
     swtich_bot_interval_sec = 5 * 60
 
@@ -36,45 +121,112 @@ def main():
 
     logdir = os.path.join(LOG_DIR, datetime.now().strftime("%Y-%m-%d-%H-%M"))
     create_or_clean_folder(logdir)
+    log_pipeline = LogPipeline(logdir).start()
+    use_log_queue(log_pipeline.queue, "main")
     main_logger = create_logger("main",
                                 log_file_path=os.path.join(logdir, 'main.log'),
                                 log_level=log_level)
 
+    wss_comm_queue = None
+    room_router = None
+    supervisor = None
+    transcript = AnswerTranscript(logdir)
+    metrics_flusher = MetricsFlusher(logdir, "main").start()
+    metrics_server = None
+    browser_pool = None
+    profiler = None
+    profile_interval_min = args.profile_interval_min if args.profile else 0
+    if profile_interval_min:
+        profiler = Profiler(os.path.join(logdir, "profile"), "main",
+                            interval_min=profile_interval_min).start()
+        main_logger.info("Profiling into {}".format(os.path.join(logdir, "profile")))
+    if args.metrics_port:
+        metrics_server = MetricsHTTPServer(logdir, args.metrics_port).start()
+        main_logger.info("Serving metrics on http://127.0.0.1:{}/metrics".format(
+            args.metrics_port))
     try:
         sub_procs = []
-        web_bots = []
-        for idx in range(args.web_bot_num):
-            web_bot = ChatGPTWebBot(
-                chrome_user_data_dir=os.path.join(
-                    WEB_DRIVER_DIR, "user_data_{}".format(idx)),
-                logger=main_logger)
-            web_bot.go_chat_page()
-            web_bots.append(web_bot)
-
-        input(("1. Make sure the ChatGPT page is loaded ready.\n"
-               "2. Setup the live cast and make it going.\n"
-               "Hit any key to continue"))
-
-        for web_bot in web_bots:
-            web_bot.prepare_chat_page()
-
-        live_url_id = args.live_url_id
-        if not live_url_id:
+        web_bots = launch_web_bots(
+            [os.path.join(WEB_DRIVER_DIR, "user_data_{}".format(idx))
+             for idx in range(args.web_bot_num)],
+            logger=main_logger, transcript=transcript)
+
+        if not args.unattended:
+            input(("1. Make sure the ChatGPT page is loaded ready.\n"
+                   "2. Setup the live cast and make it going.\n"
+                   "Hit any key to continue"))
+
+        prepare_web_bots(web_bots, ready_timeout_sec=args.page_ready_timeout_sec)
+        answer_backends = web_bots
+        if args.backend == "http":
+            session = create_http_session(args.http_concurrency)
+            display_locks = [threading.Lock() for _ in web_bots]
+            answer_backends = []
+            for idx in range(args.http_concurrency):
+                display = display_lock = None
+                if web_bots:
+                    display = web_bots[idx % len(web_bots)]
+                    display_lock = display_locks[idx % len(web_bots)]
+                answer_backends.append(HTTPStreamingBackend(
+                    args.api_url, args.api_model, session,
+                    api_key=os.environ.get(args.api_key_env),
+                    name="http_{}".format(idx), display=display,
+                    display_lock=display_lock, transcript=transcript,
+                    logger=main_logger))
+        elif args.standby_browsers > 0:
+            browser_pool = BrowserPool(args.web_bot_num, args.standby_browsers,
+                                       logger=main_logger, transcript=transcript).start()
+
+        live_url_ids = args.live_url_ids
+        if not live_url_ids:
             # A real live broadcast
-            live_url_id = input("Enter the live url ID: ")
+            live_url_ids = input("Enter the live url ID(s): ").split()
+        live_url_ids = [int(live_url_id) for live_url_id in live_url_ids]
+        if len(live_url_ids) > 1 and args.wss_client != "asyncio":
+            main_logger.info("Several live rooms share one asyncio wss client")
+        if (len(live_url_ids) > 1 or args.wss_client == "asyncio") \
+                and not args.replay_dir and ws_connect is None:
+            raise RuntimeError(
+                "the asyncio wss client requires the 'websockets' package, "
+                "pip install websockets")
 
-        while True:
-            wss_comm_queue = CommunicationQueue(maxsize=500)
+        wss_ready = multiprocessing.Event()
+        wss_heartbeat = multiprocessing.RawValue("d", 0)
+
+        def start_wss_worker(comm_queue):
             wss_p = multiprocessing.Process(target=wss_worker,
-                                            args=(int(live_url_id),
-                                                  wss_comm_queue,
+                                            args=(live_url_ids,
+                                                  comm_queue,
                                                   os.path.join(
                                                   logdir, 'wss_worker.log'),
-                                                  log_level))
+                                                  log_level,
+                                                  args.wss_client,
+                                                  args.record_dir,
+                                                  args.replay_dir,
+                                                  args.replay_speed,
+                                                  args.overflow_policy,
+                                                  profile_interval_min,
+                                                  log_pipeline.queue,
+                                                  wss_ready,
+                                                  wss_heartbeat))
             wss_p.start()
-            time.sleep(3)
-            ok = input(
-                "Is wss client successfully connected?\nn = no & exit\nnr = no & retry\nother = yes & proceed: ")
+            return wss_p
+
+        attempt = 0
+        while True:
+            wss_comm_queue = create_comm_queue(args.transport, maxsize=500)
+            wss_p = start_wss_worker(wss_comm_queue)
+            if args.unattended:
+                attempt += 1
+                if wss_ready.wait(args.wss_ready_timeout_sec):
+                    break
+                main_logger.error("No wss frame within {}s, attempt {} of {}".format(
+                    args.wss_ready_timeout_sec, attempt, args.wss_ready_retries))
+                ok = 'nr' if attempt < args.wss_ready_retries else 'n'
+            else:
+                time.sleep(3)
+                ok = input(
+                    "Is wss client successfully connected?\nn = no & exit\nnr = no & retry\nother = yes & proceed: ")
             if ok == 'n':
                 sub_procs.append(wss_p)
                 raise RuntimeError("wss client not okay")
@@ -82,46 +234,81 @@ def main():
                 wss_p.terminate()
                 wss_p.join()
                 wss_p.close()
-                del wss_comm_queue
+                wss_comm_queue.release()
                 main_logger.info("Restarting wss client ...")
                 time.sleep(3)
             else:
-                sub_procs.append(wss_p)
                 break
 
-        main_logger.info("sub procs pid: {}".format(
-            [p.pid for p in sub_procs]))
-
-        qs = QuestionSelector(wss_comm_queue,
-                              logger=main_logger)
+        main_logger.info("wss worker pid: {}".format(wss_p.pid))
+        room_router = RoomRecordRouter(wss_comm_queue)
 
-        start_time = int(time.time())
+        def restart_wss_worker():
+            if args.transport == "shm":
+                # A killed writer never publishes a half-written record.
+                return start_wss_worker(wss_comm_queue)
+            # A killed writer can leave a multiprocessing.Queue half-written,
+            # the new worker gets a queue of its own.
+            comm_queue = create_comm_queue(args.transport, maxsize=500)
+            room_router.switch_queue(comm_queue)
+            return start_wss_worker(comm_queue)
 
-        iteration = 0
-        while True:
-            now = int(time.time())
-            idx = iteration % len(web_bots)
+        # From here on a dead or stuck worker is restarted.
+        supervisor = WorkerSupervisor(restart_wss_worker, wss_p,
+                                      heartbeat=wss_heartbeat,
+                                      logger=main_logger).start()
 
-            web_bot = web_bots[idx]
-            main_logger.info("Using web_bot {} ...".format(idx))
-            web_bot.bring_to_foreground()
+        selectors = {}
+        for live_url_id in live_url_ids:
+            backlog = None
+            if args.backlog_size > 0:
+                backlog = QuestionBacklog(max_size=args.backlog_size,
+                                          max_age_sec=args.backlog_max_age_sec)
+            selectors[live_url_id] = QuestionSelector(
+                room_router.room_queue(live_url_id), logger=main_logger,
+                selection=args.selection, backlog=backlog,
+                batch_size=args.batch_size, max_prompt_chars=args.max_prompt_chars,
+                window=AdaptiveWindow(min_sec=args.window_min_sec,
+                                      max_sec=args.window_max_sec,
+                                      target_questions=args.window_target_questions))
 
-            time.sleep(2)
-            wss_comm_queue.clear()
-            web_bot.set_count_down(time_interval=qs.collect_interval)
+        answer_cache = None
+        if args.answer_cache:
+            answer_cache = AnswerCache(args.answer_cache,
+                                       max_entries=args.answer_cache_size,
+                                       ttl_sec=args.answer_cache_ttl_hours * 3600)
+            main_logger.info("Answer cache {} with {} entries".format(
+                args.answer_cache, len(answer_cache)))
 
-            q_text = qs.collect_and_select_question()
-            if q_text:
-                web_bot.send_question(q_text)
-                web_bot.wait_answer(timeout_sec=120)
-            iteration += 1
-            time.sleep(5) # wait audience to finish reading the answer
+        scheduler = BotScheduler(answer_backends, selectors,
+                                 max_in_flight=args.max_in_flight,
+                                 screen_policy=args.screen_policy,
+                                 answer_timeout_sec=args.answer_timeout_sec,
+                                 answer_cache=answer_cache,
+                                 browser_pool=browser_pool,
+                                 logger=main_logger)
+        scheduler.run_forever()
 
     finally:
         for p in sub_procs:
             p.terminate()
             p.join()
             p.close()
+        if supervisor is not None:
+            supervisor.stop()
+        if room_router is not None:
+            room_router.release()
+        elif wss_comm_queue is not None:
+            wss_comm_queue.release()
+        if browser_pool is not None:
+            browser_pool.stop()
+        transcript.close()
+        metrics_flusher.stop()
+        if metrics_server is not None:
+            metrics_server.stop()
+        if profiler is not None:
+            profiler.stop()
+        log_pipeline.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,174 @@
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from chatgpdou import create_logger
+from chatgpdou.metrics import metrics
+
+
+class BotScheduler(object):
+    """Overlaps question collection with answering across several web bots,
+    or any other AnswerBackend.
+
+    Every bot owns a single worker thread, so all driver calls of one bot
+    are serialized while different bots run concurrently. The main thread
+    keeps collecting the next question while earlier ones are answered.
+
+    screen_policy:
+        primed    -- the bot picked for the next window comes to the
+                     foreground and shows the countdown.
+        answering -- a bot comes to the foreground when it sends its
+                     question, so the streaming answer is on screen.
+    max_in_flight bounds how many questions are collected or answered at
+    the same time, 1 keeps the old strictly serial behaviour. With a
+    browser_pool, a bot whose task fails is swapped for a warm standby
+    before it takes another question.
+    """
+    screen_policies = ("primed", "answering")
+
+    def __init__(self, web_bots, selectors, max_in_flight=1,
+                 screen_policy="primed", answer_timeout_sec=120,
+                 read_delay_sec=5, answer_cache=None, browser_pool=None,
+                 logger=None):
+        if not logger:
+            self.logger = create_logger("bot_scheduler")
+        else:
+            self.logger = logger
+        if screen_policy not in self.screen_policies:
+            raise ValueError("Unknown screen policy: {}".format(screen_policy))
+
+        self.web_bots = web_bots
+        # room -> QuestionSelector, rooms take turns asking
+        self.selectors = selectors
+        self.rooms = list(selectors)
+        self.max_in_flight = max(1, min(max_in_flight, len(web_bots)))
+        self.screen_policy = screen_policy
+        self.answer_timeout_sec = answer_timeout_sec
+        self.read_delay_sec = read_delay_sec
+        self.answer_cache = answer_cache
+        self.browser_pool = browser_pool
+
+        self.executors = [ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="web_bot_{}".format(idx))
+            for idx in range(len(web_bots))]
+        self.idle_bots = queue.Queue()
+        for idx in range(len(web_bots)):
+            self.idle_bots.put(idx)
+        self.in_flight = threading.BoundedSemaphore(self.max_in_flight)
+        self.iteration = 0
+
+        self.collect_to_send_metric = metrics.histogram(
+            "collection_to_send_seconds", "From the end of a collection window to the question being sent")
+        self.first_token_metric = metrics.histogram(
+            "send_to_first_token_seconds", "From sending a question to the first answer chunk")
+        self.answer_metric = metrics.histogram(
+            "answer_duration_seconds", "Time an answer streams")
+        self.rounds_metric = metrics.counter("rounds_total", "Rounds by outcome")
+
+    def run_forever(self):
+        try:
+            while True:
+                self.run_round()
+        finally:
+            self.shutdown()
+
+    def run_round(self):
+        self.in_flight.acquire()
+        idx = self.idle_bots.get()
+        web_bot = self.web_bots[idx]
+        room = self.rooms[self.iteration % len(self.rooms)]
+        qs = self.selectors[room]
+        self.iteration += 1
+
+        self.logger.info("Using web_bot {} for room {} ...".format(idx, room))
+        if self.screen_policy == "primed":
+            self.submit(idx, web_bot.bring_to_foreground)
+
+        time.sleep(2)
+        qs.drain()
+        self.submit(idx, web_bot.set_count_down, qs.collect_interval)
+
+        q_text = qs.collect_and_select_question()
+        collected = time.time()
+        if qs.ended_early:
+            self.submit(idx, web_bot.set_count_down, 0)
+        if not q_text:
+            self.rounds_metric.inc(labels={"outcome": "empty"})
+            self.release(idx)
+            return
+        # The answer to a batch only fits that exact mix of questions.
+        cacheable = self.answer_cache is not None and not qs.batched
+        cached = None
+        if cacheable:
+            cached = self.answer_cache.get(q_text)
+        if cached:
+            self.rounds_metric.inc(labels={"outcome": "cached"})
+            self.submit(idx, self.show_cached_answer, idx, q_text, cached)
+        else:
+            self.rounds_metric.inc(labels={"outcome": "asked"})
+            self.submit(idx, self.answer, idx, q_text, collected, cacheable)
+
+    def show_cached_answer(self, idx, q_text, answer):
+        web_bot = self.web_bots[idx]
+        try:
+            web_bot.bring_to_foreground()
+            web_bot.show_answer(q_text, answer)
+            # Roughly the time to read it, no bot is busy streaming meanwhile.
+            time.sleep(min(60, 5 + len(answer) / 15) + self.read_delay_sec)
+        except Exception:
+            self.replace_bot(idx)
+            raise
+        finally:
+            self.release(idx)
+
+    def answer(self, idx, q_text, collected, cacheable=True):
+        web_bot = self.web_bots[idx]
+        try:
+            if self.screen_policy == "answering":
+                web_bot.bring_to_foreground()
+            web_bot.send_question(q_text)
+            self.collect_to_send_metric.observe(time.time() - collected)
+            completed = web_bot.wait_answer(timeout_sec=self.answer_timeout_sec)
+            timing = web_bot.last_answer_timing
+            if timing is not None:
+                if timing["time_to_first_chunk_sec"] is not None:
+                    self.first_token_metric.observe(timing["time_to_first_chunk_sec"])
+                self.answer_metric.observe(timing["stream_sec"])
+            if completed and cacheable and self.answer_cache is not None:
+                self.answer_cache.put(q_text, web_bot.last_answer or web_bot.read_answer())
+            time.sleep(self.read_delay_sec) # wait audience to finish reading the answer
+        except Exception:
+            self.replace_bot(idx)
+            raise
+        finally:
+            self.release(idx)
+
+    def replace_bot(self, idx):
+        # Runs on the bot's own worker thread, before the slot is released.
+        if self.browser_pool is None:
+            return
+        try:
+            self.web_bots[idx] = self.browser_pool.swap(self.web_bots[idx])
+        except RuntimeError as e:
+            # Keep the broken bot, its task fails and the next round retries.
+            self.logger.error("web_bot {} not replaced: {}".format(idx, str(e)))
+
+    def submit(self, idx, fn, *args):
+        future = self.executors[idx].submit(fn, *args)
+        future.add_done_callback(
+            lambda f: self.on_task_done(idx, f))
+        return future
+
+    def on_task_done(self, idx, future):
+        if not future.cancelled() and future.exception() is not None:
+            self.logger.error("web_bot {} task failed: {}".format(
+                idx, str(future.exception())))
+
+    def release(self, idx):
+        self.idle_bots.put(idx)
+        self.in_flight.release()
+
+    def shutdown(self):
+        for executor in self.executors:
+            executor.shutdown(wait=False, cancel_futures=True)
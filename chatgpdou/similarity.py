@@ -0,0 +1,140 @@
+import re
+import struct
+import random
+import hashlib
+import unicodedata
+
+punctuation_re = re.compile(r"[\W_]+", re.UNICODE)
+
+
+def normalize_question(text):
+    # Full-width to half-width, lower case, no punctuation or spaces.
+    text = unicodedata.normalize("NFKC", text).lower()
+    return punctuation_re.sub("", text)
+
+
+def char_shingles(text, n=2):
+    if len(text) <= n:
+        return {text} if text else set()
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+class QuestionCluster(object):
+    def __init__(self, cluster_id, signature):
+        self.cluster_id = cluster_id
+        self.signature = signature
+        # user_id -> question text
+        self.members = {}
+
+    @property
+    def size(self):
+        return len(self.members)
+
+
+class QuestionClusterIndex(object):
+    """Groups near-duplicate questions as they arrive.
+
+    Each question is reduced to a MinHash signature over character bigrams,
+    which suits short Chinese text without word segmentation. Signatures are
+    split into LSH bands, so finding candidate clusters is a handful of dict
+    lookups per insert, independent of how many questions were seen.
+    """
+
+    def __init__(self, num_perm=32, bands=16, threshold=0.5, max_cached_shingles=100000):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        # One shake_128 digest gives all num_perm hash values of a shingle.
+        self.hash_struct = struct.Struct("<{}I".format(num_perm))
+        # Bigrams repeat a lot across comments, so their hashes are cached.
+        self.max_cached_shingles = max_cached_shingles
+        self.shingle_hashes = {}
+        self.clear()
+
+    def clear(self):
+        self.clusters = {}
+        self.buckets = {}
+        self.user_clusters = {}
+        self.next_cluster_id = 0
+
+    def __len__(self):
+        return len(self.user_clusters)
+
+    def shingle_hash(self, shingle):
+        hashes = self.shingle_hashes.get(shingle)
+        if hashes is None:
+            if len(self.shingle_hashes) >= self.max_cached_shingles:
+                self.shingle_hashes.clear()
+            digest = hashlib.shake_128(shingle.encode("utf-8")).digest(
+                self.hash_struct.size)
+            hashes = self.hash_struct.unpack(digest)
+            self.shingle_hashes[shingle] = hashes
+        return hashes
+
+    def signature(self, text):
+        hashes = [self.shingle_hash(shingle)
+                  for shingle in char_shingles(normalize_question(text))]
+        if not hashes:
+            return None
+        return tuple(map(min, zip(*hashes)))
+
+    def band_keys(self, signature):
+        return [(band, signature[band * self.rows:(band + 1) * self.rows])
+                for band in range(self.bands)]
+
+    def similarity(self, sig_a, sig_b):
+        return sum(1 for a, b in zip(sig_a, sig_b) if a == b) / self.num_perm
+
+    def add(self, user_id, question):
+        self.remove(user_id)
+        signature = self.signature(question)
+        if signature is None:
+            return None
+        keys = self.band_keys(signature)
+
+        best, best_score = None, self.threshold
+        for key in keys:
+            cluster_id = self.buckets.get(key)
+            cluster = self.clusters.get(cluster_id)
+            if cluster is None:
+                continue
+            score = self.similarity(signature, cluster.signature)
+            if score >= best_score:
+                best, best_score = cluster, score
+
+        if best is None:
+            best = QuestionCluster(self.next_cluster_id, signature)
+            self.clusters[best.cluster_id] = best
+            self.next_cluster_id += 1
+            for key in keys:
+                if self.buckets.get(key) not in self.clusters:
+                    self.buckets[key] = best.cluster_id
+        best.members[user_id] = question
+        self.user_clusters[user_id] = best.cluster_id
+        return best
+
+    def remove(self, user_id):
+        cluster_id = self.user_clusters.pop(user_id, None)
+        if cluster_id is None:
+            return
+        cluster = self.clusters[cluster_id]
+        cluster.members.pop(user_id, None)
+        if not cluster.members:
+            del self.clusters[cluster_id]
+
+    def top(self, k):
+        # The k largest clusters, ties broken randomly like largest().
+        clusters = list(self.clusters.values())
+        random.shuffle(clusters)
+        return sorted(clusters, key=lambda cluster: cluster.size, reverse=True)[:k]
+
+    def largest(self):
+        # Ties are broken randomly, so equal-sized clusters all get a turn.
+        if not self.clusters:
+            return None
+        top = max(cluster.size for cluster in self.clusters.values())
+        return random.choice([cluster for cluster in self.clusters.values()
+                              if cluster.size == top])
@@ -0,0 +1,106 @@
+import time
+import random
+import threading
+
+from chatgpdou import create_logger
+from chatgpdou.metrics import metrics
+
+
+class Backoff(object):
+    """Exponential backoff with jitter: attempt n waits between half and
+    all of min(max_sec, base_sec * 2 ** n), so reconnecting clients don't
+    retry in lockstep."""
+
+    def __init__(self, base_sec=1, max_sec=60):
+        self.base_sec = base_sec
+        self.max_sec = max_sec
+        self.attempts = 0
+
+    def next_delay(self):
+        delay = min(self.max_sec, self.base_sec * 2 ** self.attempts)
+        self.attempts += 1
+        return random.uniform(delay / 2, delay)
+
+    def reset(self):
+        self.attempts = 0
+
+
+class WorkerSupervisor(object):
+    """Restarts the wss worker process when it exits or hangs.
+
+    start_worker() starts a new worker and returns the process, the main
+    loop keeps reading as if nothing happened. A worker counts as hung once
+    heartbeat (a shared timestamp its receive loop sets on every frame and
+    reconnect attempt) is older than stall_timeout_sec. A worker that exits
+    with code 0, like a finished replay, is left alone.
+    """
+
+    def __init__(self, start_worker, process, heartbeat=None, stall_timeout_sec=90,
+                 check_interval=2, logger=None):
+        if not logger:
+            self.logger = create_logger("worker_supervisor")
+        else:
+            self.logger = logger
+        self.start_worker = start_worker
+        self.process = process
+        self.heartbeat = heartbeat
+        self.stall_timeout_sec = stall_timeout_sec
+        self.check_interval = check_interval
+        self.backoff = Backoff()
+        self.started_at = time.time()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name="worker_supervisor")
+        self.restarts_metric = metrics.counter(
+            "wss_worker_restarts_total", "wss worker processes restarted by the supervisor")
+        self.downtime_metric = metrics.counter(
+            "wss_worker_downtime_seconds_total", "Time without a running wss worker")
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopped.wait(self.check_interval):
+            if not self.process.is_alive() and self.process.exitcode == 0:
+                self.logger.info("wss worker finished, not restarting")
+                return
+            reason = self.check()
+            if reason is None:
+                if time.time() - self.started_at > 5 * 60:
+                    self.backoff.reset()
+                continue
+            down_since = time.time()
+            self.logger.error("wss worker {}, restarting".format(reason))
+            self.terminate()
+            if self.stopped.wait(self.backoff.next_delay()):
+                return
+            self.process = self.start_worker()
+            self.started_at = time.time()
+            self.restarts_metric.inc(labels={"reason": reason.split(" ")[0]})
+            self.downtime_metric.inc(time.time() - down_since)
+            self.logger.info("wss worker restarted, pid {}".format(self.process.pid))
+
+    def check(self):
+        if not self.process.is_alive():
+            return "exited with code {}".format(self.process.exitcode)
+        if self.heartbeat is None:
+            return None
+        age = time.time() - max(self.heartbeat.value, self.started_at)
+        if age > self.stall_timeout_sec:
+            return "stalled for {:.0f}s".format(age)
+        return None
+
+    def terminate(self):
+        if self.process is None:
+            return
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+        self.process.close()
+        self.process = None
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.terminate()
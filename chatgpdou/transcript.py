@@ -0,0 +1,66 @@
+import os
+import json
+import time
+import threading
+from datetime import datetime
+
+
+class AnswerTranscript(object):
+    """Per-session record of what was answered.
+
+    Answer text is appended to transcript_<bot>.txt chunk by chunk while it
+    streams, one file per bot so concurrent answers don't interleave. Each
+    finished answer also gets one line in answer_timings.jsonl with time to
+    first chunk, stream duration and chars/s.
+    """
+
+    def __init__(self, log_dir):
+        self.log_dir = log_dir
+        self.lock = threading.Lock()
+        self.files = {}
+        self.timings_file = open(os.path.join(log_dir, "answer_timings.jsonl"),
+                                 "a", encoding="utf-8")
+
+    def bot_file(self, bot_name):
+        if bot_name not in self.files:
+            self.files[bot_name] = open(
+                os.path.join(self.log_dir, "transcript_{}.txt".format(bot_name)),
+                "a", encoding="utf-8")
+        return self.files[bot_name]
+
+    def begin_answer(self, bot_name, question):
+        transcript_file = self.bot_file(bot_name)
+        transcript_file.write("\n=== {} Q: {}\n".format(
+            datetime.now().strftime("%Y-%m-%d %H:%M:%S"), question))
+        transcript_file.flush()
+
+    def write_chunk(self, bot_name, chunk):
+        transcript_file = self.bot_file(bot_name)
+        if chunk["replace"]:
+            transcript_file.write("\n[rewritten]\n")
+        transcript_file.write(chunk["delta"])
+        transcript_file.flush()
+
+    def end_answer(self, bot_name, question, answer, timing):
+        transcript_file = self.bot_file(bot_name)
+        if timing is None:
+            transcript_file.write("\n--- incomplete\n")
+        else:
+            transcript_file.write("\n--- first chunk {}s, streamed {:.1f}s, {} chars\n".format(
+                timing["time_to_first_chunk_sec"], timing["stream_sec"], timing["chars"]))
+        transcript_file.flush()
+
+        entry = {"time": time.time(), "bot": bot_name, "question": question,
+                 "completed": timing is not None, "chars": len(answer)}
+        if timing is not None:
+            entry.update(timing)
+            entry["chars_per_sec"] = (timing["chars"] / timing["stream_sec"]
+                                      if timing["stream_sec"] > 0 else None)
+        with self.lock:
+            self.timings_file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.timings_file.flush()
+
+    def close(self):
+        for transcript_file in self.files.values():
+            transcript_file.close()
+        self.timings_file.close()
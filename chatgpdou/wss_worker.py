@@ -0,0 +1,66 @@
+import os
+import sys
+import signal
+
+from chatgpdou import use_log_queue
+from chatgpdou.douyin import DouyinLiveWebSocketServer
+from chatgpdou.douyin import DouyinLiveRoomPool
+from chatgpdou.douyin import capture_path
+from chatgpdou.metrics import MetricsFlusher
+from chatgpdou.profiling import Profiler
+
+
+def wss_worker(live_url_ids, comm_queue, log_path, log_level, wss_client="thread",
+               record_dir=None, replay_dir=None, replay_speed=1.0,
+               overflow_policy="drop_oldest", profile_interval_min=0, log_queue=None,
+               ready_event=None, heartbeat=None):
+    if log_queue is not None:
+        use_log_queue(log_queue, "wss_worker")
+    MetricsFlusher(os.path.dirname(log_path), "wss_worker").start()
+    # The main process stops this worker with terminate(); unwind so frame
+    # captures and the last profile get written, but with a non-zero code,
+    # as exit code 0 means the worker is done and the supervisor won't
+    # restart it.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    if not profile_interval_min:
+        run_wss_client(live_url_ids, comm_queue, log_path, log_level, wss_client,
+                       record_dir, replay_dir, replay_speed, overflow_policy, ready_event,
+                       heartbeat)
+        return
+    profiler = Profiler(os.path.join(os.path.dirname(log_path), "profile"),
+                        "wss_worker", interval_min=profile_interval_min).start()
+    try:
+        run_wss_client(live_url_ids, comm_queue, log_path, log_level, wss_client,
+                       record_dir, replay_dir, replay_speed, overflow_policy, ready_event,
+                       heartbeat)
+    finally:
+        profiler.stop()
+
+
+def run_wss_client(live_url_ids, comm_queue, log_path, log_level, wss_client,
+                   record_dir, replay_dir, replay_speed, overflow_policy, ready_event=None,
+                   heartbeat=None):
+    if len(live_url_ids) > 1:
+        # All rooms share one event loop in this process.
+        room_pool = DouyinLiveRoomPool(
+            live_url_ids, comm_queue, log_path=log_path, log_level=log_level,
+            record_dir=record_dir, replay_dir=replay_dir, replay_speed=replay_speed,
+            overflow_policy=overflow_policy, ready_event=ready_event, heartbeat=heartbeat)
+        try:
+            room_pool.run_async()
+        finally:
+            room_pool.close()
+        return
+    wss_server = DouyinLiveWebSocketServer(
+        live_url_ids[0], comm_queue, log_path=log_path, log_level=log_level,
+        record_path=capture_path(record_dir, live_url_ids[0]),
+        overflow_policy=overflow_policy, ready_event=ready_event, heartbeat=heartbeat)
+    try:
+        if replay_dir:
+            wss_server.run_replay(capture_path(replay_dir, live_url_ids[0]), replay_speed)
+        elif wss_client == "asyncio":
+            wss_server.run_async()
+        else:
+            wss_server.run_forever()
+    finally:
+        wss_server.close()